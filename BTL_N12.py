@@ -1,91 +1,892 @@
 import time
 import psycopg2
 import os
+import functools
+import bisect
+import io
+import queue
+import threading
+import json
+import re
+import inspect
+import struct
+import mmap
+import warnings
+import hashlib
+import shutil
+import weakref
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
-def loadratings(ratingstablename, ratingsfilepath, openconnection):
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Bảng lưu thông tin về các lược đồ phân mảnh đã tạo
+METADATA_TABLE = 'partition_metadata'
+
+# Tiền tố tên bảng của từng lược đồ phân mảnh
+SCHEME_PREFIXES = {'range': 'range_part', 'rrobin': 'rrobin_part', 'hash': 'hash_part'}
+
+# Hằng số nhân của hàm băm Knuth, dùng chung cho SQL và Python để hai phía cho cùng kết quả
+HASH_MULTIPLIER = 2654435761
+
+# Số dòng mỗi lần lấy từ server-side cursor khi truy vấn các mảnh
+QUERY_BATCH_SIZE = 10000
+
+# Số dòng tối đa được chuyển giữa các mảnh trong một giao dịch khi phân mảnh lại
+REPARTITION_BATCH_SIZE = 50000
+
+# Kích thước mỗi khối dữ liệu (byte) mà RatingsCopyReader chuẩn bị cho COPY
+COPY_CHUNK_SIZE = 1 << 20
+
+# Kích thước mỗi khối file (byte) được phân tích cùng lúc bằng NumPy
+PARSE_BLOCK_SIZE = 64 << 20
+
+# Thư mục và dung lượng tối đa mặc định của cache dữ liệu ratings đã phân tích
+RATINGS_CACHE_DIR = '.ratings_cache'
+RATINGS_CACHE_MAX_BYTES = 2 << 30
+
+# Các chỉ mục mặc định được tạo trên mỗi mảnh sau khi nạp dữ liệu ở chế độ bulk load
+BULKLOAD_INDEXES = (('userid', 'movieid'), ('rating',))
+
+# Tham số kết nối mặc định khi không có kết nối mẫu (PooledInserter, InsertService);
+# mật khẩu do libpq lấy từ PGPASSWORD hoặc ~/.pgpass
+DEFAULT_CONNECTION = {'dbname': 'postgres', 'user': 'postgres', 'host': 'localhost'}
+
+# Tên file mô tả và phiên bản định dạng của thư mục snapshot
+SNAPSHOT_MANIFEST = 'manifest.json'
+SNAPSHOT_VERSION = 1
+
+# Cấu hình đo đạc: sink nhận bản ghi của mỗi lần gọi hàm và có chạy EXPLAIN hay không
+_instrumentation = {'sink': None, 'explain': False}
+_current_trace = threading.local()
+
+class MemorySink:
+    """
+    Instrumentation sink keeping every record in memory, e.g. for tests.
+    """
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class JsonLinesSink:
+    """
+    Instrumentation sink appending every record as one JSON line to a file.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock, open(self.filepath, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+def set_instrumentation(sink=None, explain=False):
+    """
+    Send one record per entry point call (wall time, rows, statements and their durations)
+    to `sink`; sink=None turns instrumentation off. Rows count the rows written to data tables;
+    SELECTs and partition_metadata bookkeeping are left out. With explain=True the records also
+    carry EXPLAIN (ANALYZE, BUFFERS) plans. Writes are explained instead of executed, so they
+    still run exactly once (the cursor's rowcount still reports the rows written); SELECTs are explained in an extra run before the real one. Statements
+    whose result rows are needed (WITH fan-outs, RETURNING) cannot be replaced that way and get
+    an estimated plan (plain EXPLAIN, marked 'analyzed': False) before they run.
+    """
+    _instrumentation['sink'] = sink
+    _instrumentation['explain'] = explain
+
+_CTAS_RE = re.compile(r'^\s*CREATE\s+(UNLOGGED\s+)?TABLE\s+\S+\s+AS\s', re.IGNORECASE)
+
+def _plan_rows(plan):
+    # Với INSERT/UPDATE/DELETE số dòng bị tác động nằm ở nút con của ModifyTable
+    node = plan[0]['Plan']
+    if node.get('Node Type') == 'ModifyTable':
+        return sum(child.get('Actual Rows', 0) for child in node.get('Plans', []))
+    return node.get('Actual Rows')
+
+class _TracingCursor(psycopg2.extensions.cursor):
+    """
+    Cursor recording every statement it runs into the trace of the current entry point call.
+    After a write was replaced by EXPLAIN ANALYZE, rowcount is the row count of the write itself.
+    """
+    _explained_rows = None
+
+    @property
+    def rowcount(self):
+        # rowcount gốc của EXPLAIN ANALYZE là số dòng của kế hoạch (1), không phải số dòng được ghi
+        if self._explained_rows is not None:
+            return self._explained_rows
+        return super().rowcount
+
+    def _record(self, kind, query, run):
+        self._explained_rows = None
+        record = getattr(_current_trace, 'record', None)
+        if record is None:
+            return run()
+        statement = {'kind': kind, 'sql': query if isinstance(query, str) else query.decode()}
+        start_time = time.perf_counter()
+        try:
+            return run(statement)
+        except Exception as ex:
+            statement['error'] = str(ex)
+            record.setdefault('error', str(ex))
+            raise
+        finally:
+            statement['seconds'] = time.perf_counter() - start_time
+            if 'rows' not in statement and 'error' not in statement and self.rowcount >= 0:
+                statement['rows'] = self.rowcount
+            sql = statement['sql']
+            if not sql.lstrip().upper().startswith('SELECT') and METADATA_TABLE not in sql:
+                record['rows'] += statement.get('rows') or 0
+            record['statements'].append(statement)
+
+    def _explained_execute(self, statement, query, vars):
+        text = query if isinstance(query, str) else query.decode()
+        head = text.lstrip().split(None, 1)[0].upper() if text.strip() else ''
+        explain = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) '
+        if head == 'SELECT':
+            super().execute(explain + text, vars)
+            statement['plan'] = self.fetchone()[0]
+        elif head == 'WITH' or (head in ('INSERT', 'UPDATE', 'DELETE') and 'RETURNING' in text.upper()):
+            # Cần kết quả thật của câu lệnh nên chỉ lấy kế hoạch ước lượng, không thực thi thêm lần nào
+            super().execute('EXPLAIN (FORMAT JSON) ' + text, vars)
+            statement['plan'] = self.fetchone()[0]
+            statement['analyzed'] = False
+        elif (head in ('INSERT', 'UPDATE', 'DELETE') and 'RETURNING' not in text.upper()) or _CTAS_RE.match(text):
+            # EXPLAIN ANALYZE thực thi câu lệnh đúng một lần nên dùng nó thay cho câu lệnh gốc
+            super().execute(explain + text, vars)
+            statement['plan'] = self.fetchone()[0]
+            statement['rows'] = _plan_rows(statement['plan'])
+            self._explained_rows = statement['rows']
+            return
+        super().execute(query, vars)
+
+    def execute(self, query, vars=None):
+        if getattr(_current_trace, 'record', None) is None:
+            self._explained_rows = None
+            return super().execute(query, vars)
+        if _instrumentation['explain']:
+            return self._record('execute', query, lambda s: self._explained_execute(s, query, vars))
+        return self._record('execute', query, lambda s: super(_TracingCursor, self).execute(query, vars))
+
+    def executemany(self, query, vars_list):
+        return self._record('executemany', query,
+                            lambda s=None: super(_TracingCursor, self).executemany(query, vars_list))
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._record('copy', sql, lambda s=None: super(_TracingCursor, self).copy_expert(sql, file, size))
+
+def _trace_statement_rows(cur, rows):
+    """
+    Replace the traced row count of the last statement of cur, for statements whose rowcount is
+    not the number of rows written (e.g. the fan-out, whose result is one row per partition).
+    """
+    record = getattr(_current_trace, 'record', None)
+    if record is None or not isinstance(cur, _TracingCursor) or not record['statements']:
+        return
+    statement = record['statements'][-1]
+    if 'error' not in statement:
+        record['rows'] += rows - (statement.get('rows') or 0)
+        statement['rows'] = rows
+
+def instrumented(func):
+    """
+    Decorator tracing an entry point taking `openconnection` while a sink is configured.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        sink = _instrumentation['sink']
+        if sink is None or getattr(_current_trace, 'record', None) is not None:
+            return func(*args, **kwargs)
+        openconnection = signature.bind(*args, **kwargs).arguments['openconnection']
+        record = {'function': func.__name__, 'started_at': time.time(), 'rows': 0, 'statements': []}
+        previous_factory = openconnection.cursor_factory
+        openconnection.cursor_factory = _TracingCursor
+        _current_trace.record = record
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record['seconds'] = time.perf_counter() - start_time
+            _current_trace.record = None
+            openconnection.cursor_factory = previous_factory
+            sink.emit(record)
+    return wrapper
+
+class RatingsCopyReader:
+    """
+    File-like adapter turning '::'-delimited MovieLens lines into COPY text rows on demand.
+    Reading stops at byte offset `end` when given, so a worker can stream only its slice.
+    """
+    header = b''
+    trailer = b''
+
+    def __init__(self, infile, end=None, chunk_size=COPY_CHUNK_SIZE):
+        self._infile = infile
+        self._end = end
+        self._pos = infile.tell()
+        self._chunk_size = chunk_size
+        self._buffer = bytearray(self.header)
+        self._eof = False
+        self.rows = 0
+
+    def _encode(self, parts):
+        return b'%s\t%s\t%s\n' % (parts[0], parts[1], parts[2])
+
+    def _fill(self):
+        # Chuyển một khối dòng '::' sang định dạng COPY, chỉ giữ các dòng đủ 4 trường
+        out = []
+        size = 0
+        while size < self._chunk_size:
+            if self._end is not None and self._pos >= self._end:
+                self._eof = True
+                break
+            line = self._infile.readline()
+            if not line:
+                self._eof = True
+                break
+            self._pos += len(line)
+            parts = line.strip().split(b'::')
+            if len(parts) == 4:
+                row = self._encode(parts)
+                out.append(row)
+                size += len(row)
+        self.rows += len(out)
+        if self._eof:
+            out.append(self.trailer)
+        self._buffer += b''.join(out)
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size is None or size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        while not self._eof and b'\n' not in self._buffer:
+            self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        return self.read(end)
+
+# Định dạng COPY nhị phân của PostgreSQL: chữ ký, cờ và độ dài phần mở rộng của header,
+# mỗi dòng gồm số trường rồi (độ dài, giá trị) của từng trường, kết thúc bằng -1
+_BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+_BINARY_COPY_TRAILER = struct.pack('>h', -1)
+_BINARY_RATING_ROW = struct.Struct('>hiiiiid')
+
+class BinaryRatingsCopyReader(RatingsCopyReader):
+    """
+    RatingsCopyReader variant encoding rows on the client into PostgreSQL binary COPY format
+    (int4, int4, float8), so the server does not parse any text.
+    """
+    header = _BINARY_COPY_HEADER
+    trailer = _BINARY_COPY_TRAILER
+
+    def _encode(self, parts):
+        return _BINARY_RATING_ROW.pack(3, 4, int(parts[0]), 4, int(parts[1]), 8, float(parts[2]))
+
+def _ratings_copy(ratingstablename, infile, end=None, binary=False):
+    """
+    Return (COPY statement, reader) streaming the ratings file in text or binary format.
+    """
+    if binary:
+        return (f"COPY {ratingstablename} (UserID, MovieID, Rating) FROM STDIN WITH (FORMAT binary)",
+                BinaryRatingsCopyReader(infile, end))
+    return (f"COPY {ratingstablename} (UserID, MovieID, Rating) FROM STDIN WITH (FORMAT text, NULL '')",
+            RatingsCopyReader(infile, end))
+
+def _connection_factory(openconnection=None, connect=None):
+    """
+    Return a zero-argument callable opening new connections with every connection parameter of
+    openconnection (host, port, database, user, password, ...), or DEFAULT_CONNECTION without one.
+    """
+    if connect is not None:
+        return connect
+    if openconnection is None:
+        return functools.partial(psycopg2.connect, **DEFAULT_CONNECTION)
+    params = openconnection.get_dsn_parameters()
+    # get_dsn_parameters() không trả về mật khẩu nên lấy riêng từ thông tin của kết nối
+    password = openconnection.info.password
+    if password:
+        params['password'] = password
+    return functools.partial(psycopg2.connect, **params)
+
+def _split_file(filepath, parts):
+    """
+    Split a file into at most `parts` (start, end) byte ranges aligned on line boundaries.
+    """
+    size = os.path.getsize(filepath)
+    offsets = [0]
+    with open(filepath, 'rb') as f:
+        for k in range(1, parts):
+            pos = size * k // parts
+            if pos <= offsets[-1]:
+                continue
+            # Lùi một byte rồi đọc hết dòng để điểm cắt luôn nằm ngay sau ký tự xuống dòng
+            f.seek(pos - 1)
+            f.readline()
+            pos = f.tell()
+            if offsets[-1] < pos < size:
+                offsets.append(pos)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def _copy_ratings_slice(connect, ratingstablename, ratingsfilepath, start, end, binary=False):
+    """
+    Worker: COPY the rows in bytes [start, end) of the ratings file over its own connection.
+    """
+    start_time = time.perf_counter()
+    conn = connect()
+    try:
+        with open(ratingsfilepath, 'rb') as infile:
+            infile.seek(start)
+            sql, reader = _ratings_copy(ratingstablename, infile, end, binary)
+            with conn.cursor() as cur:
+                cur.copy_expert(sql, reader)
+        conn.commit()
+    finally:
+        conn.close()
+    return reader.rows, time.perf_counter() - start_time
+
+@instrumented
+def loadratings(ratingstablename, ratingsfilepath, openconnection, workers=1, connect=None, binary=False,
+                cache=None, unlogged=False, append=False):
+    """
+    Load the '::'-delimited ratings file into a new ratings table.
+    With binary=True rows are sent in binary COPY format instead of text. With a RatingsCache
+    the parsed columns are reused across loads of the same file and sent in binary format.
+    With unlogged=True the table is created UNLOGGED; see bulkload.
+    With append=True the file is a delta: its rows are added to the existing ratings table and
+    routed into the existing partitions in the same transaction (see _append_ratings).
+    """
     try:
         cur = openconnection.cursor()
+        if append:
+            # Trên kết nối AUTOCOMMIT mỗi lệnh tự commit: tạm tắt để delta được nạp vào ratings
+            # và định tuyến vào các mảnh trong cùng một giao dịch
+            autocommit = openconnection.autocommit
+            if autocommit:
+                openconnection.autocommit = False
+            try:
+                start_time = time.perf_counter()
+                rows, routed = _append_ratings(cur, ratingstablename, ratingsfilepath, binary)
+                openconnection.commit()
+            except Exception:
+                openconnection.rollback()
+                raise
+            finally:
+                if autocommit:
+                    openconnection.autocommit = True
+            elapsed = time.perf_counter() - start_time
+            print(f"Data appended successfully into {ratingstablename} "
+                  f"({rows} rows, {rows / max(elapsed, 1e-9):.0f} rows/s"
+                  + ''.join(f", {scheme}: {counts}" for scheme, counts in routed.items()) + ")")
+            return
+
         cur.execute("DROP TABLE IF EXISTS " + ratingstablename)
         cur.execute("""
-            CREATE TABLE """ + ratingstablename + """ (
+            CREATE """ + ('UNLOGGED ' if unlogged else '') + """TABLE """ + ratingstablename + """ (
                 UserID INTEGER,
                 MovieID INTEGER,
                 Rating FLOAT
             )
         """)
 
-        # Tạo file tạm thời với định dạng phù hợp
-        temp_file = 'temp_ratings.dat'
-        with open(ratingsfilepath, 'r', encoding='utf-8') as infile, open(temp_file, 'w', encoding='utf-8') as outfile:
-            for line in infile:
-                parts = line.strip().split('::')
-                if len(parts) == 4:
-                    outfile.write(f"{parts[0]}\t{parts[1]}\t{parts[2]}\n")
-
-        # Sử dụng copy_from để nạp dữ liệu
-        with open(temp_file, 'r', encoding='utf-8') as f:
-            cur.copy_from(f, ratingstablename, sep='\t', null='')
-        openconnection.commit()
-        print("Data loaded successfully into " + ratingstablename)
+        if cache is not None:
+            if np is None:
+                raise ImportError('RatingsCache cần thư viện numpy')
+            # Lấy các cột đã phân tích từ cache (hoặc phân tích rồi lưu vào cache) và gửi dạng nhị phân
+            start_time = time.perf_counter()
+            rows = 0
+            for userids, movieids, ratings in _ratings_column_blocks(ratingsfilepath, cache):
+                _copy_binary_columns(cur, ratingstablename, userids, movieids, ratings)
+                rows += len(userids)
+            openconnection.commit()
+            elapsed = time.perf_counter() - start_time
+            print(f"Data loaded successfully into {ratingstablename} "
+                  f"({rows} rows, {rows / max(elapsed, 1e-9):.0f} rows/s)")
+            return
+
+        if workers > 1:
+            # Bảng phải được commit trước để các kết nối của worker nhìn thấy
+            openconnection.commit()
+            _loadratings_parallel(ratingstablename, ratingsfilepath, openconnection, workers, connect, binary)
+            return
 
-        # Xóa file tạm thời
-        os.remove(temp_file)
+        # Chuyển đổi từng khối dòng ngay khi COPY đọc tới, không cần file tạm
+        start_time = time.perf_counter()
+        with open(ratingsfilepath, 'rb') as infile:
+            sql, reader = _ratings_copy(ratingstablename, infile, binary=binary)
+            cur.copy_expert(sql, reader)
+        openconnection.commit()
+        elapsed = time.perf_counter() - start_time
+        print(f"Data loaded successfully into {ratingstablename} "
+              f"({reader.rows} rows, {reader.rows / max(elapsed, 1e-9):.0f} rows/s)")
     except psycopg2.Error as e:
         print("Error loading ratings: " + str(e))
         openconnection.rollback()
     finally:
         cur.close()
 
-def rangepartition(ratingstablename, numberofpartitions, openconnection):
+def _append_ratings(cur, ratingstablename, ratingsfilepath, binary=False):
+    """
+    COPY a delta file into a temporary table, append it to ratings and route it into the
+    partitions of every scheme recorded in partition_metadata. Only the delta is scanned;
+    round-robin placement continues from the stored counter.
+    Must run inside a transaction: the staging table is dropped at the end, and on error the
+    rollback removes it together with the rows already appended.
+    Returns (row count, {scheme: rows per partition}).
+    """
+    staging = f'{ratingstablename}_delta'
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {ratingstablename} (
+            UserID INTEGER,
+            MovieID INTEGER,
+            Rating FLOAT
+        )
+    """)
+    cur.execute(f'DROP TABLE IF EXISTS pg_temp.{staging}')
+    cur.execute(f'CREATE TEMP TABLE {staging} (userid INTEGER, movieid INTEGER, rating FLOAT)')
+    with open(ratingsfilepath, 'rb') as infile:
+        sql, reader = _ratings_copy(staging, infile, binary=binary)
+        cur.copy_expert(sql, reader)
+    cur.execute(f'INSERT INTO {ratingstablename} (userid, movieid, rating) '
+                f'SELECT userid, movieid, rating FROM {staging}')
+    rows = cur.rowcount
+
+    routed = {}
+    metadata = _load_partition_metadata(cur, 'range')
+    if metadata is not None:
+        numberofpartitions, _, bounds, _ = metadata
+        routed['range'] = _fanout_partitions(
+            cur, f'SELECT userid, movieid, rating, {_range_bucket_sql(bounds)} AS part FROM {staging}',
+            SCHEME_PREFIXES['range'], numberofpartitions)
+
+    # Giữ chỗ một lần cho cả delta trên con trỏ round-robin, các dòng được đánh số tiếp từ vị trí đó
+    slot = _reserve_rrobin_slots(cur, rows) if rows else None
+    if slot is not None:
+        first_index, numberofpartitions = slot
+        routed['rrobin'] = _fanout_partitions(
+            cur, f'SELECT userid, movieid, rating, '
+                 f'MOD({first_index} + ROW_NUMBER() OVER () - 1, {numberofpartitions}) AS part FROM {staging}',
+            SCHEME_PREFIXES['rrobin'], numberofpartitions)
+
+    metadata = _load_partition_metadata(cur, 'hash')
+    if metadata is not None:
+        numberofpartitions, _, _, key = metadata
+        routed['hash'] = _fanout_partitions(
+            cur, f'SELECT userid, movieid, rating, {_hash_bucket_sql(key, numberofpartitions)} AS part FROM {staging}',
+            SCHEME_PREFIXES['hash'], numberofpartitions)
+    cur.execute(f'DROP TABLE {staging}')
+    return rows, routed
+
+def _loadratings_parallel(ratingstablename, ratingsfilepath, openconnection, workers, connect=None, binary=False):
+    """
+    Load the ratings file with `workers` processes, each COPYing one newline-aligned slice.
+    """
+    connect = _connection_factory(openconnection, connect)
+    slices = _split_file(ratingsfilepath, workers)
+    start_time = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=len(slices)) as executor:
+            futures = [executor.submit(_copy_ratings_slice, connect, ratingstablename, ratingsfilepath, start, end, binary)
+                       for start, end in slices]
+            results = [f.result() for f in futures]
+    except Exception as ex:
+        # Một worker lỗi thì xóa phần dữ liệu các worker khác đã nạp để không để lại bảng thiếu dòng
+        with openconnection.cursor() as cur:
+            cur.execute(f"TRUNCATE {ratingstablename}")
+        openconnection.commit()
+        print(f"Error loading ratings: {str(ex)}")
+        return
+    elapsed = time.perf_counter() - start_time
+
+    total_rows = 0
+    for k, (rows, seconds) in enumerate(results):
+        total_rows += rows
+        print(f"  worker {k}: {rows} rows in {seconds:.3f}s ({rows / max(seconds, 1e-9):.0f} rows/s)")
+    print(f"Data loaded successfully into {ratingstablename} "
+          f"({total_rows} rows, {len(slices)} workers, {elapsed:.3f}s, {total_rows / max(elapsed, 1e-9):.0f} rows/s)")
+
+def _check_partition_count(numberofpartitions):
+    if not isinstance(numberofpartitions, int) or numberofpartitions <= 0:
+        raise ValueError(f'Số lượng mảnh không hợp lệ: {numberofpartitions}')
+
+def _range_bounds(numberofpartitions):
+    """
+    Upper bound of every range partition: partition 0 is rating <= u0, partition i is u(i-1) < rating <= ui.
+    """
+    _check_partition_count(numberofpartitions)
+    d = 5 / numberofpartitions
+    return [i * d + d for i in range(numberofpartitions)]
+
+def _range_histogram(cur, ratingstablename, sample_percent=None):
+    """
+    Return [(rating, count)] sorted by rating, from the whole table or a TABLESAMPLE of it.
+    """
+    sample = f' TABLESAMPLE SYSTEM ({float(sample_percent)})' if sample_percent else ''
+    cur.execute(f'SELECT rating, COUNT(*) FROM {ratingstablename}{sample} GROUP BY rating ORDER BY rating')
+    return cur.fetchall()
+
+def _equidepth_bounds(histogram, numberofpartitions):
+    """
+    Upper bounds splitting a rating histogram into partitions of roughly equal row counts.
+    Every cut falls on a distinct rating value; when there are fewer distinct values than
+    partitions the remaining partitions stay empty. An empty histogram gives equal-width bounds.
+    """
+    _check_partition_count(numberofpartitions)
+    if not histogram:
+        return _range_bounds(numberofpartitions)
+    values = [value for value, _ in histogram]
+    cumulative = []
+    running = 0
+    for _, count in histogram:
+        running += count
+        cumulative.append(running)
+    bounds = []
+    previous = -1
+    for k in range(1, numberofpartitions):
+        target = running * k / numberofpartitions
+        # Chừa lại ít nhất một giá trị riêng cho mỗi mảnh phía sau nếu còn đủ giá trị
+        lo = min(previous + 1, len(values) - 1)
+        hi = max(lo, len(values) - 1 - (numberofpartitions - k))
+        j = min(range(lo, hi + 1), key=lambda j: abs(cumulative[j] - target))
+        bounds.append(values[j])
+        previous = j
+    # Mảnh cuối nhận mọi giá trị còn lại, tới tận cận trên của miền rating
+    bounds.append(max([_range_bounds(numberofpartitions)[-1]] + values))
+    return bounds
+
+def _is_equal_width(bounds):
+    """
+    Whether range bounds are the equal-width bounds of _range_bounds (not equi-depth ones).
+    """
+    return all(abs(a - b) < 1e-9 for a, b in zip(bounds, _range_bounds(len(bounds))))
+
+def _imbalance_ratio(histogram, bounds):
+    """
+    Largest partition size divided by the mean partition size, predicted from a histogram.
+    """
+    counts = [0] * len(bounds)
+    for value, count in histogram:
+        i = bisect.bisect_left(bounds, value)
+        if i < len(bounds):
+            counts[i] += count
+    mean = sum(counts) / len(counts)
+    return max(counts) / mean if mean else 1.0
+
+def _range_bucket_sql(bounds, otherwise=None):
+    """
+    SQL expression giving the range partition index of `rating` for the given upper bounds,
+    or `otherwise` (NULL by default) for ratings above the last bound.
+    """
+    whens = ' '.join(f'WHEN rating <= {max_rate} THEN {i}' for i, max_rate in enumerate(bounds))
+    if otherwise is not None:
+        whens += f' ELSE {otherwise}'
+    return f'CASE {whens} END'
+
+def _range_predicate_sql(bounds, i):
+    """
+    WHERE condition selecting the rows of range partition i.
+    """
+    if i == 0:
+        return f'rating <= {bounds[0]}'
+    return f'rating > {bounds[i - 1]} AND rating <= {bounds[i]}'
+
+def _create_partition_tables(cur, prefix, numberofpartitions, start=0, unlogged=False):
+    for i in range(start, numberofpartitions):
+        cur.execute(f"CREATE {'UNLOGGED ' if unlogged else ''}TABLE {prefix}{i} "
+                    f"(userid INTEGER, movieid INTEGER, rating FLOAT)")
+
+def _fanout_partitions(cur, source_sql, prefix, numberofpartitions):
+    """
+    Route all rows of source_sql (userid, movieid, rating, part) into prefix0..prefixN-1 with one
+    statement, in the caller's transaction. Returns the row count of every partition.
+
+    The source query runs once and its result is materialized by PostgreSQL, but every insI
+    sub-statement filters that materialized result again, so routing costs N passes over the
+    source rows; it is meant for small sources such as an appended delta or the rows left over by
+    repartition. rangepartition and roundrobinpartition route the whole ratings table in a single
+    pass with _copy_demux_partitions instead.
+    """
+    inserts = ',\n'.join(
+        f'ins{i} AS (INSERT INTO {prefix}{i} (userid, movieid, rating) '
+        f'SELECT userid, movieid, rating FROM src WHERE part = {i})'
+        for i in range(numberofpartitions)
+    )
+    cur.execute(f'WITH src AS ({source_sql}),\n{inserts}\nSELECT part, COUNT(*) FROM src GROUP BY part')
+    counts = [0] * numberofpartitions
+    for part, count in cur.fetchall():
+        if part is not None:
+            counts[part] = count
+    _trace_statement_rows(cur, sum(counts))
+    return counts
+
+def _save_partition_metadata(cur, scheme, numberofpartitions, next_index=None, bounds=None, partitionkey=None,
+                             nodes=None):
+    """
+    Record the layout of a partitioning scheme in the partition_metadata table.
+    next_index is the global row position where the round-robin cursor ended,
+    bounds are the upper bounds of the range partitions,
+    partitionkey is the column hashed by hash partitioning,
+    nodes is the node id of every partition placed by NodePlacement.
+    """
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {METADATA_TABLE} (
+            scheme TEXT PRIMARY KEY,
+            numberofpartitions INTEGER NOT NULL,
+            next_index BIGINT,
+            bounds FLOAT[],
+            partitionkey TEXT
+        )
+    """)
+    cur.execute(f"ALTER TABLE {METADATA_TABLE} ADD COLUMN IF NOT EXISTS partitionkey TEXT")
+    cur.execute(f"ALTER TABLE {METADATA_TABLE} ADD COLUMN IF NOT EXISTS nodes TEXT[]")
+    cur.execute(f"""
+        INSERT INTO {METADATA_TABLE} (scheme, numberofpartitions, next_index, bounds, partitionkey, nodes)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (scheme) DO UPDATE
+        SET numberofpartitions = EXCLUDED.numberofpartitions,
+            next_index = EXCLUDED.next_index,
+            bounds = EXCLUDED.bounds,
+            partitionkey = EXCLUDED.partitionkey,
+            nodes = EXCLUDED.nodes
+    """, (scheme, numberofpartitions, next_index, bounds, partitionkey, nodes))
+
+def _load_partition_metadata(cur, scheme):
+    """
+    Return (numberofpartitions, next_index, bounds, partitionkey) of a scheme,
+    or None if it was never recorded.
+    """
+    cur.execute("SELECT to_regclass(%s)", (METADATA_TABLE,))
+    if cur.fetchone()[0] is None:
+        return None
+    cur.execute(f"SELECT * FROM {METADATA_TABLE} WHERE scheme = %s", (scheme,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    columns = [column[0] for column in cur.description]
+    record = dict(zip(columns, row))
+    return (record['numberofpartitions'], record['next_index'], record['bounds'], record.get('partitionkey'))
+
+def _load_partition_nodes(cur, scheme):
+    """
+    Node id of every partition of a scheme placed by NodePlacement, or None.
+    """
+    cur.execute("SELECT to_regclass(%s)", (METADATA_TABLE,))
+    if cur.fetchone()[0] is None:
+        return None
+    cur.execute(f"SELECT * FROM {METADATA_TABLE} WHERE scheme = %s", (scheme,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in cur.description], row)).get('nodes')
+
+def _reserve_rrobin_slots(cur, count):
+    """
+    Atomically take `count` consecutive round-robin positions from the metadata counter.
+    The row lock taken by UPDATE serializes concurrent inserters until their transaction ends.
+    Returns (first_index, numberofpartitions), or None if round-robin metadata is missing.
+    """
+    cur.execute("SELECT to_regclass(%s)", (METADATA_TABLE,))
+    if cur.fetchone()[0] is None:
+        return None
+    cur.execute(f"""
+        UPDATE {METADATA_TABLE} SET next_index = next_index + %s
+        WHERE scheme = 'rrobin'
+        RETURNING next_index - %s, numberofpartitions
+    """, (count, count))
+    return cur.fetchone()
+
+def _range_index(rating, bounds):
+    """
+    Index of the range partition holding `rating`, using the same boundaries as rangepartition.
+    """
+    i = bisect.bisect_left(bounds, rating)
+    if i >= len(bounds):
+        raise ValueError(f'Rating {rating} nằm ngoài miền giá trị của các mảnh')
+    return i
+
+def _copy_rows(cur, tablename, rows):
+    """
+    Bulk-write (userid, movieid, rating) tuples into a table with a single COPY.
+    """
+    buf = io.StringIO(''.join(f'{int(u)}\t{int(m)}\t{float(r)}\n' for u, m, r in rows))
+    cur.copy_expert(f'COPY {tablename} (userid, movieid, rating) FROM STDIN', buf)
+
+def _write_partition_groups(cur, prefix, rows, indexes):
+    """
+    Group rows by their partition index and write every group with one COPY.
+    """
+    groups = {}
+    for row, i in zip(rows, indexes):
+        groups.setdefault(i, []).append(row)
+    for i, group in sorted(groups.items()):
+        _copy_rows(cur, f'{prefix}{i}', group)
+    return {i: len(group) for i, group in groups.items()}
+
+def _run_in_worker_transactions(jobs, run, connect, workers, before_commit=None):
     """
-    Based on range of ratings, create new partitions from main table (ratings)
+    Run run(cur, table name, payload) for every (table name, payload) job on a fixed set of at most
+    `workers` connections. Each connection takes jobs from a shared queue and keeps all of its
+    jobs in one open transaction; nothing is committed until every job has succeeded, so a failure
+    never leaves part of the tables behind. before_commit runs just before the commits.
+    Returns the run time of every job.
+    """
+    pending = queue.Queue()
+    for k, job in enumerate(jobs):
+        pending.put((k, job))
+    seconds = [None] * len(jobs)
+    stop = threading.Event()
+
+    def worker():
+        conn = connect()
+        done = []
+        try:
+            with conn.cursor() as cur:
+                while not stop.is_set():
+                    try:
+                        k, (tb_name, payload) = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    start_time = time.perf_counter()
+                    run(cur, tb_name, payload)
+                    seconds[k] = time.perf_counter() - start_time
+                    done.append(tb_name)
+        except Exception:
+            # Báo các worker khác dừng lấy việc mới
+            stop.set()
+            conn.close()
+            raise
+        return conn, done
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker) for _ in range(max(1, min(workers, len(jobs))))]
+    results = []
+    error = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as ex:
+            error = error or ex
+
+    # Có worker lỗi: rollback toàn bộ các worker còn lại, không bảng nào được tạo
+    if error is not None:
+        for conn, _ in results:
+            conn.rollback()
+            conn.close()
+        raise error
+
+    committed = []
+    try:
+        if before_commit is not None:
+            before_commit()
+        for conn, done in results:
+            conn.commit()
+            committed += done
+    except Exception:
+        # Commit lỗi giữa chừng: xóa các bảng đã commit trước đó
+        conn = connect()
+        try:
+            with conn.cursor() as cur:
+                for tb_name in committed:
+                    cur.execute(f'DROP TABLE IF EXISTS {tb_name}')
+            conn.commit()
+        finally:
+            conn.close()
+        raise
+    finally:
+        for conn, _ in results:
+            conn.close()
+    return seconds
+
+def _build_partitions_parallel(statements, connect, workers):
+    """
+    Run one CREATE TABLE ... AS statement per partition on `workers` worker connections.
+    statements is a list of (table name, sql); see _run_in_worker_transactions.
+    Returns the build time of every partition.
+    """
+    seconds = _run_in_worker_transactions(statements, lambda cur, tb_name, sql: cur.execute(sql), connect, workers)
+    slowest = max(range(len(seconds)), key=seconds.__getitem__)
+    for (tb_name, _), elapsed in zip(statements, seconds):
+        print(f"  {tb_name}: {elapsed:.3f}s" + (" (chậm nhất)" if tb_name == statements[slowest][0] else ""))
+    return seconds
+
+@instrumented
+def rangepartition(ratingstablename, numberofpartitions, openconnection, workers=0, connect=None,
+                   equidepth=False, sample_percent=None, unlogged=False):
+    """
+    Based on range of ratings, create new partitions from main table (ratings).
+    Without workers ratings is read once and streamed into one COPY per partition, each on its own
+    connection (see _copy_demux_partitions); with workers > 0 the partitions are built concurrently
+    on that many worker connections, each with its own scan.
+    With equidepth=True the bounds are chosen from a rating histogram (of a TABLESAMPLE of
+    sample_percent % when given) so that partitions hold similar row counts, instead of
+    splitting 0-5 into equal widths; rangeinsert routes against the stored bounds.
+    With unlogged=True the partitions are created UNLOGGED; see bulkload.
     """
     try:
         cur = openconnection.cursor()
+        bounds = _range_bounds(numberofpartitions)
+        if equidepth:
+            # Chọn cận theo phân bố thực tế để các mảnh có số dòng gần bằng nhau
+            histogram = _range_histogram(cur, ratingstablename, sample_percent)
+            before = _imbalance_ratio(histogram, bounds)
+            bounds = _equidepth_bounds(histogram, numberofpartitions)
+            print(f"Độ lệch (mảnh lớn nhất / trung bình): {before:.2f} -> {_imbalance_ratio(histogram, bounds):.2f}")
 
-        # Tính phạm vi rating cho mỗi mảnh
-        d = 5 / numberofpartitions
-
-        # Với mỗi mảnh thứ i tạo bảng mới có tiền tố range_part + i, 
-        # Lấy dữ liệu từ bảng rating gốc thêm vào các mảnh
-        for i in range(numberofpartitions):
-            tb_name = f'range_part{i}'
-            min_rate = i * d
-            max_rate = min_rate + d
-            if i == 0:
-                cur.execute(
-                    f'CREATE TABLE {tb_name} AS '
-                    f'SELECT userid, movieid, rating FROM {ratingstablename} '
-                    f'WHERE rating <= {max_rate};'
-                )
-            else:
-                cur.execute(
-                    f'CREATE TABLE {tb_name} AS '
-                    f'SELECT userid, movieid, rating FROM {ratingstablename} '
-                    f'WHERE rating > {min_rate} and rating <= {max_rate};'
-                )
+        if workers > 0:
+            # Mỗi worker tạo một mảnh trên kết nối riêng
+            _build_partitions_parallel(
+                [(f'range_part{i}',
+                  f"CREATE {'UNLOGGED ' if unlogged else ''}TABLE range_part{i} AS SELECT "
+                  f'userid, movieid, rating FROM {ratingstablename} '
+                  f'WHERE {_range_predicate_sql(bounds, i)}')
+                 for i in range(numberofpartitions)],
+                _connection_factory(openconnection, connect), workers
+            )
+        else:
+            # Quét bảng ratings một lần duy nhất bằng COPY TO, tính số thứ tự mảnh cho từng dòng
+            # rồi chuyển dòng đó tới lệnh COPY FROM của đúng mảnh
+            connect = _connection_factory(openconnection, connect)
+            _copy_demux_partitions(
+                cur,
+                f'SELECT userid, movieid, rating, {_range_bucket_sql(bounds)} AS part FROM {ratingstablename}',
+                'range_part', [connect] * numberofpartitions, unlogged=unlogged
+            )
+        _save_partition_metadata(cur, 'range', numberofpartitions, bounds=bounds)
         cur.close()
         openconnection.commit()
     except Exception as ex: 
         openconnection.rollback()
         print(f'Phân mảng ngang theo khoảng thất bại: {str(ex)}')
 
+@instrumented
 def rangeinsert(ratingstablename, userid, movieid, rating, openconnection):
     try:
         cur = openconnection.cursor()
 
-        # Tìm số lượng mảnh thông qua đếm số lượng bảng có tiền tố là range_part
-        cur.execute(f"SELECT COUNT(*) FROM pg_stat_user_tables WHERE relname LIKE \'range_part%\';")
-        number_of_partitions = cur.fetchone()[0]
+        # Lấy cận trên của các mảnh từ bảng metadata; nếu chưa có thì đếm số bảng range_part như trước
+        metadata = _load_partition_metadata(cur, 'range')
+        if metadata is not None:
+            bounds = metadata[2]
+        else:
+            cur.execute("SELECT COUNT(*) FROM pg_stat_user_tables WHERE relname LIKE 'range_part%';")
+            bounds = _range_bounds(cur.fetchone()[0])
 
         # Dựa vào giá trị rating của bản ghi mới, tìm được số thứ tự mảnh phù hợp
         # Từ số thứ tự, tìm được tên bảng rồi chèn bản ghi vào như thông thường
-        d = 5 / number_of_partitions
-        i = int(rating / d)
-        if rating % d == 0 and i != 0:
-            i = i - 1
-        tb_name = f'range_part{i}'
-        cur.execute(f"INSERT INTO {tb_name} (userid, movieid, rating) values ({userid}, {movieid}, {rating})")
+        tb_name = f'range_part{_range_index(rating, bounds)}'
+        cur.execute(f"INSERT INTO {tb_name} (userid, movieid, rating) VALUES (%s, %s, %s)",
+                    (userid, movieid, rating))
 
         cur.close()
         openconnection.commit()
@@ -93,27 +894,74 @@ def rangeinsert(ratingstablename, userid, movieid, rating, openconnection):
         openconnection.rollback()
         print(f'Chèn dữ liệu vào phân mảng ngang theo khoảng thất bại: {str(ex)}')
 
-def roundrobinpartition(ratingstablename, numberofpartitions, openconnection):
+def rangeinsert_many(ratingstablename, rows, openconnection):
+    """
+    Insert many (userid, movieid, rating) tuples into their range partitions in one transaction.
+    """
+    try:
+        cur = openconnection.cursor()
+        rows = list(rows)
+
+        metadata = _load_partition_metadata(cur, 'range')
+        if metadata is not None:
+            bounds = metadata[2]
+        else:
+            cur.execute("SELECT COUNT(*) FROM pg_stat_user_tables WHERE relname LIKE 'range_part%';")
+            bounds = _range_bounds(cur.fetchone()[0])
+
+        # Tính mảnh đích của từng dòng ở phía client rồi ghi mỗi nhóm bằng một lệnh COPY
+        sizes = _write_partition_groups(cur, 'range_part', rows, [_range_index(r[2], bounds) for r in rows])
+
+        cur.close()
+        openconnection.commit()
+        print(f"Chèn {len(rows)} bản ghi vào {len(sizes)} mảnh theo khoảng thành công.")
+    except Exception as ex:
+        openconnection.rollback()
+        print(f'Chèn dữ liệu vào phân mảng ngang theo khoảng thất bại: {str(ex)}')
+
+@instrumented
+def roundrobinpartition(ratingstablename, numberofpartitions, openconnection, workers=0, connect=None,
+                        unlogged=False):
     """
     Based on round-robin distribution, create new partitions from main table (ratings).
+    Without workers the rows are numbered once while ratings is streamed out and every row goes
+    to the COPY of its partition (see _copy_demux_partitions); with workers > 0 the numbered rows
+    are staged once and the partitions are built concurrently on that many worker connections.
+    With unlogged=True the partitions are created UNLOGGED; see bulkload.
     """
     try:
         cur = openconnection.cursor()
         prefix = 'rrobin_part'
+        _check_partition_count(numberofpartitions)
+        numbered_sql = (f'SELECT userid, movieid, rating, MOD(ROW_NUMBER() OVER () - 1, {numberofpartitions}) AS part '
+                        f'FROM {ratingstablename}')
 
-        # Tạo và điền dữ liệu vào các bảng phân mảnh
-        for i in range(numberofpartitions):
-            tb_name = f'{prefix}{i}'
-            cur.execute(f"""
-                CREATE TABLE {tb_name} AS
-                SELECT userid, movieid, rating
-                FROM (
-                    SELECT userid, movieid, rating,
-                           ROW_NUMBER() OVER () - 1 AS rnum
-                    FROM {ratingstablename}
-                ) AS temp
-                WHERE MOD(rnum, {numberofpartitions}) = {i}
-            """)
+        if workers > 0:
+            # Đánh số các dòng một lần vào bảng trung gian, sau đó các worker tạo các mảnh song song từ bảng này
+            staging = f'{ratingstablename}_rrobin_staging'
+            cur.execute(f'DROP TABLE IF EXISTS {staging}')
+            cur.execute(f'CREATE UNLOGGED TABLE {staging} AS {numbered_sql}')
+            total_rows = cur.rowcount
+            openconnection.commit()
+            try:
+                _build_partitions_parallel(
+                    [(f'{prefix}{i}',
+                      f"CREATE {'UNLOGGED ' if unlogged else ''}TABLE {prefix}{i} AS "
+                      f'SELECT userid, movieid, rating FROM {staging} WHERE part = {i}')
+                     for i in range(numberofpartitions)],
+                    _connection_factory(openconnection, connect), workers
+                )
+            finally:
+                cur.execute(f'DROP TABLE IF EXISTS {staging}')
+                openconnection.commit()
+        else:
+            # Đánh số các dòng một lần duy nhất trong lúc COPY TO rồi chuyển mỗi dòng tới lệnh COPY FROM của mảnh đó
+            connect = _connection_factory(openconnection, connect)
+            total_rows = sum(rows for rows, _ in _copy_demux_partitions(
+                cur, numbered_sql, prefix, [connect] * numberofpartitions, unlogged=unlogged))
+
+        # Lưu vị trí con trỏ round-robin để các lần chèn sau tiếp tục từ đó
+        _save_partition_metadata(cur, 'rrobin', numberofpartitions, total_rows)
         cur.close()
         openconnection.commit()
         print(f"Phân mảnh round-robin hoàn thành với {numberofpartitions} bảng.")
@@ -121,6 +969,7 @@ def roundrobinpartition(ratingstablename, numberofpartitions, openconnection):
         openconnection.rollback()
         print(f'Phân mảng ngang theo round-robin thất bại: {str(ex)}')
 
+@instrumented
 def roundrobininsert(ratingstablename, userid, movieid, rating, openconnection):
     """
     Insert a new record into the appropriate round-robin partition table.
@@ -129,17 +978,23 @@ def roundrobininsert(ratingstablename, userid, movieid, rating, openconnection):
         cur = openconnection.cursor()
         prefix = 'rrobin_part'
 
-        # Đếm số lượng bảng phân mảnh
-        cur.execute("SELECT COUNT(*) FROM pg_stat_user_tables WHERE relname LIKE %s", (f'{prefix}%',))
-        number_of_partitions = cur.fetchone()[0]
-        if number_of_partitions == 0:
-            raise Exception("Không tìm thấy bảng phân mảnh round-robin.")
-
-        # Xác định bảng đích dựa trên tổng số bản ghi hiện tại
-        cur.execute("insert into " + ratingstablename + "(userid, movieid, rating) values (" + str(userid) + "," + str(movieid) + "," + str(rating) + ");")
-        cur.execute("SELECT COUNT (*) FROM " + ratingstablename + ";");
-        total_rows = (cur.fetchall())[0][0];
-        partition_index = (total_rows - 1) % number_of_partitions
+        cur.execute(f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES (%s, %s, %s)",
+                    (userid, movieid, rating))
+
+        # Lấy vị trí tiếp theo của con trỏ round-robin từ bảng metadata
+        slot = _reserve_rrobin_slots(cur, 1)
+        if slot is not None:
+            next_index, number_of_partitions = slot
+            partition_index = next_index % number_of_partitions
+        else:
+            # Chưa có metadata: đếm số bảng phân mảnh và xác định bảng đích dựa trên tổng số bản ghi
+            cur.execute("SELECT COUNT(*) FROM pg_stat_user_tables WHERE relname LIKE %s", (f'{prefix}%',))
+            number_of_partitions = cur.fetchone()[0]
+            if number_of_partitions == 0:
+                raise Exception("Không tìm thấy bảng phân mảnh round-robin.")
+            cur.execute("SELECT COUNT(*) FROM " + ratingstablename)
+            total_rows = cur.fetchone()[0]
+            partition_index = (total_rows - 1) % number_of_partitions
         tb_name = f'{prefix}{partition_index}'
 
         # Chèn dữ liệu vào bảng phân mảnh
@@ -155,6 +1010,1606 @@ def roundrobininsert(ratingstablename, userid, movieid, rating, openconnection):
         openconnection.rollback()
         print(f'Chèn dữ liệu vào phân mảng ngang theo round-robin thất bại: {str(ex)}')
 
+def roundrobininsert_many(ratingstablename, rows, openconnection):
+    """
+    Insert many (userid, movieid, rating) tuples in one transaction, placing them exactly
+    as consecutive roundrobininsert calls would.
+    """
+    try:
+        cur = openconnection.cursor()
+        prefix = 'rrobin_part'
+        rows = list(rows)
+        if not rows:
+            return
+        _copy_rows(cur, ratingstablename, rows)
+
+        # Giữ chỗ len(rows) vị trí liên tiếp của con trỏ round-robin trong một lần cập nhật
+        slot = _reserve_rrobin_slots(cur, len(rows))
+        if slot is not None:
+            first_index, number_of_partitions = slot
+        else:
+            cur.execute("SELECT COUNT(*) FROM pg_stat_user_tables WHERE relname LIKE %s", (f'{prefix}%',))
+            number_of_partitions = cur.fetchone()[0]
+            if number_of_partitions == 0:
+                raise Exception("Không tìm thấy bảng phân mảnh round-robin.")
+            cur.execute("SELECT COUNT(*) FROM " + ratingstablename)
+            first_index = cur.fetchone()[0] - len(rows)
+
+        indexes = [(first_index + k) % number_of_partitions for k in range(len(rows))]
+        sizes = _write_partition_groups(cur, prefix, rows, indexes)
+
+        cur.close()
+        openconnection.commit()
+        print(f"Chèn {len(rows)} bản ghi vào {len(sizes)} mảnh round-robin thành công.")
+    except Exception as ex:
+        openconnection.rollback()
+        print(f'Chèn dữ liệu vào phân mảng ngang theo round-robin thất bại: {str(ex)}')
+
+def _hash_index(value, numberofpartitions):
+    """
+    Hash partition index of an integer key (Knuth multiplicative hash modulo 2^32).
+    """
+    return (int(value) * HASH_MULTIPLIER) % 4294967296 % numberofpartitions
+
+def _hash_bucket_sql(key, numberofpartitions):
+    """
+    SQL expression computing _hash_index of column `key` on the server.
+    """
+    return (f'MOD(MOD(MOD({key}::BIGINT * {HASH_MULTIPLIER}, 4294967296) + 4294967296, 4294967296), '
+            f'{numberofpartitions})')
+
+@instrumented
+def hashpartition(ratingstablename, numberofpartitions, openconnection, key='userid'):
+    """
+    Based on a hash of `key` (userid or movieid), create new partitions from main table (ratings),
+    so all ratings of a user (or movie) end up in the same partition.
+    """
+    try:
+        cur = openconnection.cursor()
+        prefix = SCHEME_PREFIXES['hash']
+        _check_partition_count(numberofpartitions)
+        if key not in ('userid', 'movieid'):
+            raise ValueError(f'Cột phân mảnh không hợp lệ: {key}')
+
+        # Quét bảng ratings một lần và chuyển từng dòng vào mảnh theo giá trị băm của khóa
+        _create_partition_tables(cur, prefix, numberofpartitions)
+        _fanout_partitions(
+            cur,
+            f'SELECT userid, movieid, rating, {_hash_bucket_sql(key, numberofpartitions)} AS part '
+            f'FROM {ratingstablename}',
+            prefix, numberofpartitions
+        )
+        _save_partition_metadata(cur, 'hash', numberofpartitions, partitionkey=key)
+        cur.close()
+        openconnection.commit()
+    except Exception as ex:
+        openconnection.rollback()
+        print(f'Phân mảnh ngang theo hàm băm thất bại: {str(ex)}')
+
+@instrumented
+def hashinsert(ratingstablename, userid, movieid, rating, openconnection):
+    """
+    Insert a new record into the hash partition of its key.
+    """
+    try:
+        cur = openconnection.cursor()
+        metadata = _load_partition_metadata(cur, 'hash')
+        if metadata is None:
+            raise Exception("Không tìm thấy metadata của phân mảnh theo hàm băm.")
+        number_of_partitions, key = metadata[0], metadata[3]
+        value = userid if key == 'userid' else movieid
+        tb_name = f"{SCHEME_PREFIXES['hash']}{_hash_index(value, number_of_partitions)}"
+        cur.execute(f"INSERT INTO {tb_name} (userid, movieid, rating) VALUES (%s, %s, %s)",
+                    (userid, movieid, rating))
+        cur.close()
+        openconnection.commit()
+    except Exception as ex:
+        openconnection.rollback()
+        print(f'Chèn dữ liệu vào phân mảnh theo hàm băm thất bại: {str(ex)}')
+
+def _run_statements_parallel(statements, connect, workers):
+    """
+    Run and commit every (table name, sql) statement on its own worker connection, up to
+    `workers` at a time. Returns the run time of every statement; the first error is re-raised
+    after all statements have finished.
+    """
+    def run(sql):
+        start_time = time.perf_counter()
+        conn = connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql)
+            conn.commit()
+        finally:
+            conn.close()
+        return time.perf_counter() - start_time
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run, sql) for _, sql in statements]
+    seconds = []
+    error = None
+    for future in futures:
+        try:
+            seconds.append(future.result())
+        except Exception as ex:
+            seconds.append(None)
+            error = error or ex
+    if error is not None:
+        raise error
+    return seconds
+
+def buildindexes(tables, openconnection, indexes=BULKLOAD_INDEXES, workers=4, connect=None, setlogged=False):
+    """
+    Create `indexes` (tuples of column names) on every table concurrently, then ANALYZE them.
+    With setlogged=True the tables are first converted from UNLOGGED to logged tables.
+    """
+    try:
+        connect = _connection_factory(openconnection, connect)
+        # Các bước phải theo thứ tự: SET LOGGED giữ khóa độc quyền, các lệnh CREATE INDEX
+        # trên cùng một bảng thì chạy song song được với nhau
+        phases = []
+        if setlogged:
+            phases.append(('SET LOGGED', [(tb_name, f'ALTER TABLE {tb_name} SET LOGGED') for tb_name in tables]))
+        phases.append(('CREATE INDEX', [
+            (tb_name, f"CREATE INDEX IF NOT EXISTS {tb_name}_{'_'.join(columns)}_idx "
+                      f"ON {tb_name} ({', '.join(columns)})")
+            for tb_name in tables for columns in indexes
+        ]))
+        phases.append(('ANALYZE', [(tb_name, f'ANALYZE {tb_name}') for tb_name in tables]))
+
+        for name, statements in phases:
+            if not statements:
+                continue
+            start_time = time.perf_counter()
+            seconds = _run_statements_parallel(statements, connect, workers)
+            print(f"  {name}: {len(statements)} lệnh, {time.perf_counter() - start_time:.3f}s "
+                  f"(lâu nhất {max(seconds):.3f}s)")
+    except Exception as ex:
+        print(f'Tạo chỉ mục thất bại: {str(ex)}')
+
+def bulkload(ratingstablename, ratingsfilepath, numberofpartitions, openconnection, indexes=BULKLOAD_INDEXES,
+             workers=4, connect=None, binary=False):
+    """
+    Load the ratings file and build range and round-robin partitions in bulk-load mode:
+    every table is written UNLOGGED without indexes, then converted to a logged table,
+    indexed per partition in parallel and ANALYZEd.
+    """
+    start_time = time.perf_counter()
+    # Ghi dữ liệu vào các bảng UNLOGGED chưa có chỉ mục để COPY và phân mảnh không phải ghi WAL
+    loadratings(ratingstablename, ratingsfilepath, openconnection, binary=binary, unlogged=True)
+    rangepartition(ratingstablename, numberofpartitions, openconnection, workers=workers, connect=connect,
+                   unlogged=True)
+    roundrobinpartition(ratingstablename, numberofpartitions, openconnection, workers=workers, connect=connect,
+                        unlogged=True)
+    load_seconds = time.perf_counter() - start_time
+
+    # Chỉ mục chỉ tạo trên các mảnh; bảng ratings chỉ cần chuyển sang LOGGED và cập nhật thống kê
+    start_time = time.perf_counter()
+    partitions = [f'{prefix}{i}' for prefix in ('range_part', 'rrobin_part') for i in range(numberofpartitions)]
+    buildindexes(partitions, openconnection, indexes, workers, connect, setlogged=True)
+    buildindexes([ratingstablename], openconnection, (), workers, connect, setlogged=True)
+    index_seconds = time.perf_counter() - start_time
+    print(f"Bulk load hoàn thành: nạp dữ liệu {load_seconds:.3f}s, tạo chỉ mục và ANALYZE {index_seconds:.3f}s")
+
+class PooledInserter:
+    """
+    Warm connection pool for the single-row insert hot path. Every pooled connection prepares
+    one server-side INSERT per partition table the first time it is used, later calls only bind
+    parameters to it. minconn connections (all maxconn by default) are opened up front and kept
+    open; up to maxconn are used at once. connect defaults to DEFAULT_CONNECTION.
+    """
+    def __init__(self, ratingstablename='ratings', minconn=None, maxconn=4, connect=None):
+        connect = _connection_factory(connect=connect)
+        self.ratingstablename = ratingstablename
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        # Câu lệnh đã PREPARE gắn với chính đối tượng kết nối, tự mất đi khi kết nối bị hủy
+        self._prepared = weakref.WeakKeyDictionary()
+        self._bounds = None
+        for _ in range(maxconn if minconn is None else minconn):
+            self._idle.put(connect())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get().close()
+        self._prepared.clear()
+
+    def refresh(self):
+        """
+        Forget cached range bounds, e.g. after the partitions were rebuilt.
+        """
+        self._bounds = None
+
+    def _execute(self, conn, cur, name, sql, params):
+        # Chuẩn bị câu lệnh ở phía server trong lần dùng đầu tiên trên kết nối này
+        prepared = self._prepared.setdefault(conn, set())
+        if name not in prepared:
+            cur.execute(f'PREPARE {name} AS {sql}')
+            prepared.add(name)
+        if params:
+            cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+        else:
+            cur.execute(f'EXECUTE {name}')
+
+    def _insert_partition(self, conn, cur, tb_name, userid, movieid, rating):
+        self._execute(conn, cur, f'ins_{tb_name}',
+                      f'INSERT INTO {tb_name} (userid, movieid, rating) VALUES ($1::integer, $2::integer, $3::float)',
+                      (userid, movieid, rating))
+
+    def _getconn(self):
+        # Ưu tiên kết nối vừa dùng (LIFO) để các câu lệnh đã chuẩn bị được dùng lại nhiều nhất
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _putconn(self, conn, broken):
+        if broken:
+            self._prepared.pop(conn, None)
+            conn.close()
+        else:
+            self._idle.put(conn)
+        self._slots.release()
+
+    def _run(self, work):
+        conn = self._getconn()
+        broken = False
+        try:
+            with conn.cursor() as cur:
+                result = work(conn, cur)
+            conn.commit()
+            return result
+        except Exception:
+            broken = conn.closed != 0
+            if not broken:
+                conn.rollback()
+            raise
+        finally:
+            self._putconn(conn, broken)
+
+    def rangeinsert(self, userid, movieid, rating):
+        def work(conn, cur):
+            if self._bounds is None:
+                metadata = _load_partition_metadata(cur, 'range')
+                if metadata is None:
+                    raise Exception("Không tìm thấy metadata của phân mảnh theo khoảng.")
+                self._bounds = metadata[2]
+            tb_name = f'range_part{_range_index(rating, self._bounds)}'
+            self._insert_partition(conn, cur, tb_name, userid, movieid, rating)
+            return tb_name
+        return self._run(work)
+
+    def roundrobininsert(self, userid, movieid, rating):
+        def work(conn, cur):
+            self._execute(conn, cur, 'ins_ratings',
+                          f'INSERT INTO {self.ratingstablename} (userid, movieid, rating) '
+                          f'VALUES ($1::integer, $2::integer, $3::float)',
+                          (userid, movieid, rating))
+            self._execute(conn, cur, 'next_rrobin_slot',
+                          f"UPDATE {METADATA_TABLE} SET next_index = next_index + 1 WHERE scheme = 'rrobin' "
+                          f"RETURNING next_index - 1, numberofpartitions",
+                          ())
+            slot = cur.fetchone()
+            if slot is None:
+                raise Exception("Không tìm thấy metadata của phân mảnh round-robin.")
+            tb_name = f'rrobin_part{slot[0] % slot[1]}'
+            self._insert_partition(conn, cur, tb_name, userid, movieid, rating)
+            return tb_name
+        return self._run(work)
+
+def repartition(ratingstablename, numberofpartitions, openconnection, scheme='range',
+                batch_size=REPARTITION_BATCH_SIZE):
+    """
+    Change the partition count of an existing range or round-robin partitioning, moving only the
+    rows whose partition changes. Range rows move when their new bounds differ (equal-width bounds
+    stay equal-width, equi-depth bounds are recomputed from ratings for the new count); the k-th row of
+    the round-robin sequence (rrobin_part(k % N), in physical order) moves when k % new N changes.
+    Rows are moved in committed batches of batch_size, so no long exclusive lock is held.
+    The metadata is switched to the new layout before the rows move, so inserts that read it
+    (rangeinsert, roundrobininsert, loadratings(append=True), InsertService batches and
+    PooledInserter.roundrobininsert) already go to their new partitions; queries may miss rows until
+    the move has finished. PooledInserter caches the range bounds: call its refresh() afterwards,
+    otherwise its range inserts keep using the old layout.
+    At the end the old partitions are locked against writes, rows that still landed in the wrong
+    partition (written with the old layout) are moved, and only then are surplus partitions dropped.
+    An interrupted round-robin repartition should be finished by re-running roundrobinpartition.
+    On an AUTOCOMMIT connection autocommit is switched off for the duration and restored afterwards.
+    Returns {'moved': rows moved, 'total': total rows, 'seconds': elapsed}.
+    """
+    # Các lô và LOCK TABLE cuối cùng cần giao dịch tường minh: tạm tắt AUTOCOMMIT như loadratings(append=True)
+    autocommit = openconnection.autocommit
+    if autocommit:
+        openconnection.autocommit = False
+    try:
+        start_time = time.perf_counter()
+        if scheme not in ('range', 'rrobin'):
+            raise ValueError(f'Lược đồ phân mảnh không hợp lệ: {scheme}')
+        cur = openconnection.cursor()
+        prefix = 'range_part' if scheme == 'range' else 'rrobin_part'
+        _check_partition_count(numberofpartitions)
+        old_n, old_bounds = _partition_layout(cur, scheme, prefix)
+        if old_n == 0:
+            raise Exception(f"Không tìm thấy bảng phân mảnh {prefix}.")
+        new_n = numberofpartitions
+        new_bounds = None
+        if scheme == 'range':
+            # Giữ nguyên kiểu cận đang dùng: cận equi-depth được tính lại cho số mảnh mới
+            if _is_equal_width(old_bounds):
+                new_bounds = _range_bounds(new_n)
+            else:
+                new_bounds = _equidepth_bounds(_range_histogram(cur, ratingstablename), new_n)
+
+        # Tạo thêm các mảnh mới khi tăng số lượng mảnh
+        _create_partition_tables(cur, prefix, new_n, start=old_n)
+
+        # Chuyển metadata sang bố cục mới trước khi lập kế hoạch, commit cùng kế hoạch: các lệnh chèn
+        # sau đó đi thẳng vào mảnh mới. Với round-robin, UPDATE khóa dòng con trỏ nên chờ các lệnh
+        # chèn đang giữ chỗ theo bố cục cũ commit xong, và kế hoạch bên dưới thấy được các dòng đó
+        save_rrobin_metadata = False
+        if scheme == 'range':
+            _save_partition_metadata(cur, 'range', new_n, bounds=new_bounds)
+        else:
+            cur.execute("SELECT to_regclass(%s)", (METADATA_TABLE,))
+            save_rrobin_metadata = True
+            if cur.fetchone()[0] is not None:
+                cur.execute(f"UPDATE {METADATA_TABLE} SET numberofpartitions = %s WHERE scheme = 'rrobin'", (new_n,))
+                save_rrobin_metadata = cur.rowcount != 1
+
+        # Lập kế hoạch: ghi lại ctid và mảnh đích của mọi dòng phải di chuyển (một lượt quét mỗi mảnh)
+        cur.execute('DROP TABLE IF EXISTS repartition_plan')
+        cur.execute('CREATE TEMP TABLE repartition_plan (seq BIGSERIAL, src INTEGER, row_ctid TID, dest INTEGER)')
+        total_rows = 0
+        for i in range(old_n):
+            if scheme == 'range':
+                # Dòng nằm ngoài các cận mới ở lại mảnh hiện tại (hoặc mảnh cuối nếu mảnh này bị xóa)
+                dest_sql = _range_bucket_sql(new_bounds, otherwise=min(i, new_n - 1))
+            else:
+                dest_sql = f'MOD({i} + {old_n} * (ROW_NUMBER() OVER (ORDER BY ctid) - 1), {new_n})'
+            cur.execute(f"""
+                WITH t AS (SELECT ctid AS row_ctid, {dest_sql} AS dest FROM {prefix}{i}),
+                planned AS (INSERT INTO repartition_plan (src, row_ctid, dest)
+                            SELECT {i}, row_ctid, dest FROM t WHERE dest <> {i})
+                SELECT COUNT(*) FROM t
+            """)
+            total_rows += cur.fetchone()[0]
+        cur.execute('CREATE INDEX ON repartition_plan (src, seq)')
+        openconnection.commit()
+
+        # Di chuyển theo từng lô: mỗi lô xóa dòng khỏi mảnh nguồn và chèn vào mảnh đích trong cùng giao dịch
+        moved_rows = 0
+        for i in range(old_n):
+            cur.execute('SELECT MIN(seq), MAX(seq) FROM repartition_plan WHERE src = %s', (i,))
+            first_seq, last_seq = cur.fetchone()
+            if first_seq is None:
+                continue
+            inserts = ''.join(
+                f', ins{j} AS (INSERT INTO {prefix}{j} (userid, movieid, rating) '
+                f'SELECT userid, movieid, rating FROM moved_dest WHERE dest = {j})'
+                for j in range(new_n) if j != i
+            )
+            for lo in range(first_seq - 1, last_seq, batch_size):
+                cur.execute(f"""
+                    WITH batch AS (
+                        SELECT row_ctid, dest FROM repartition_plan
+                        WHERE src = {i} AND seq > {lo} AND seq <= {lo + batch_size}
+                    ),
+                    moved AS (
+                        DELETE FROM {prefix}{i} WHERE ctid = ANY(ARRAY(SELECT row_ctid FROM batch))
+                        RETURNING userid, movieid, rating, ctid AS row_ctid
+                    ),
+                    moved_dest AS (
+                        SELECT moved.userid, moved.movieid, moved.rating, batch.dest
+                        FROM moved JOIN batch ON batch.row_ctid = moved.row_ctid
+                    ){inserts}
+                    SELECT COUNT(*) FROM moved_dest
+                """)
+                moved_rows += cur.fetchone()[0]
+                openconnection.commit()
+
+        # Chưa có metadata round-robin: tạo con trỏ tại cuối dãy hiện tại
+        if save_rrobin_metadata:
+            _save_partition_metadata(cur, 'rrobin', new_n, total_rows)
+
+        # Khóa ghi các mảnh cũ (vẫn đọc được), chuyển nốt các dòng được chèn theo bố cục cũ
+        # trong lúc di chuyển, sau đó mới xóa các mảnh thừa
+        cur.execute(f"LOCK TABLE {', '.join(f'{prefix}{i}' for i in range(old_n))} IN SHARE ROW EXCLUSIVE MODE")
+        if scheme == 'range':
+            for i in range(old_n):
+                dest_sql = _range_bucket_sql(new_bounds, otherwise=min(i, new_n - 1))
+                moved_rows += sum(_fanout_partitions(
+                    cur,
+                    f'DELETE FROM {prefix}{i} WHERE {dest_sql} <> {i} '
+                    f'RETURNING userid, movieid, rating, {dest_sql} AS part',
+                    prefix, new_n))
+        else:
+            # Vị trí round-robin không suy ra được từ nội dung dòng: dòng còn sót trong các mảnh bị xóa
+            # được cấp vị trí mới từ con trỏ
+            for i in range(new_n, old_n):
+                cur.execute(f'DELETE FROM {prefix}{i} RETURNING userid, movieid, rating')
+                leftover = cur.fetchall()
+                if leftover:
+                    first_index, _ = _reserve_rrobin_slots(cur, len(leftover))
+                    _write_partition_groups(cur, prefix, leftover,
+                                            [(first_index + k) % new_n for k in range(len(leftover))])
+                    moved_rows += len(leftover)
+        for i in range(new_n, old_n):
+            cur.execute(f'DROP TABLE {prefix}{i}')
+        cur.execute('DROP TABLE repartition_plan')
+        cur.close()
+        openconnection.commit()
+
+        elapsed = time.perf_counter() - start_time
+        print(f"Phân mảnh lại {prefix}: {old_n} -> {new_n} mảnh, di chuyển {moved_rows}/{total_rows} dòng "
+              f"({100.0 * moved_rows / max(total_rows, 1):.1f}%) trong {elapsed:.3f}s")
+        return {'moved': moved_rows, 'total': total_rows, 'seconds': elapsed}
+    except Exception as ex:
+        openconnection.rollback()
+        print(f'Phân mảnh lại thất bại: {str(ex)}')
+    finally:
+        if autocommit:
+            openconnection.autocommit = True
+
+class InsertService:
+    """
+    Insert service for many concurrent producers. Rows submitted from any thread are grouped into
+    micro-batches (max_batch rows or max_delay seconds), routed to their partitions and written
+    by a pool of `connections` writer connections, so batches are pipelined. Every row gets a
+    Future resolving to its partition table once its batch is committed.
+
+    A single dispatcher assigns round-robin positions in submission order by reserving a whole
+    batch of slots from the metadata counter, so the assignment is strictly ordered and gap-free.
+    Range rows are routed with the bounds read from partition_metadata for every batch, so a
+    repartition is picked up by the next batch.
+    A batch failing with a transient error (lost connection, deadlock, serialization failure) is
+    retried on its reserved slots; after `retries` failed attempts its range rows fail, but its
+    round-robin rows keep being retried (with backoff) until they are written, since giving up
+    would leave a gap. close() therefore waits for them. Any other error (e.g. a partition table
+    that no longer exists) fails the whole batch at once and its round-robin slots stay empty.
+    Rows are validated when submitted, so bad values fail before they take a slot. connect defaults to DEFAULT_CONNECTION.
+    """
+    def __init__(self, ratingstablename='ratings', connect=None, connections=4, max_batch=1000,
+                 max_delay=0.01, retries=2):
+        connect = _connection_factory(connect=connect)
+        self.ratingstablename = ratingstablename
+        self._connect = connect
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._retries = retries
+        self._requests = queue.Queue()
+        self._idle = queue.Queue()
+        self._in_flight = threading.Semaphore(2 * connections)
+        self._writers = ThreadPoolExecutor(max_workers=connections)
+        self._control = connect()
+        self._closed = False
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit_range(self, userid, movieid, rating):
+        return self._submit('range', (userid, movieid, rating))
+
+    def submit_roundrobin(self, userid, movieid, rating):
+        return self._submit('rrobin', (userid, movieid, rating))
+
+    def _submit(self, scheme, row):
+        if self._closed:
+            raise RuntimeError('InsertService đã đóng')
+        userid, movieid, rating = row
+        row = (int(userid), int(movieid), float(rating))
+        future = Future()
+        self._requests.put((scheme, row, future))
+        return future
+
+    def close(self):
+        """
+        Flush every pending row, wait for the writes and close all connections.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._requests.put(None)
+        self._dispatcher.join()
+        self._writers.shutdown(wait=True)
+        self._control.close()
+        while not self._idle.empty():
+            self._idle.get().close()
+
+    def _next_batch(self):
+        # Chờ dòng đầu tiên, sau đó gom thêm cho tới khi đủ max_batch dòng hoặc hết max_delay giây
+        first = self._requests.get()
+        if first is None:
+            return None, True
+        batch = [first]
+        deadline = time.perf_counter() + self._max_delay
+        while len(batch) < self._max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _dispatch(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if not batch:
+                continue
+            range_items = [item for item in batch if item[0] == 'range']
+            rrobin_items = [item for item in batch if item[0] == 'rrobin']
+            try:
+                with self._control.cursor() as cur:
+                    range_indexes = []
+                    if range_items:
+                        # Đọc lại cận cho mỗi lô: sau khi phân mảnh lại, lô tiếp theo đi vào đúng mảnh mới
+                        metadata = _load_partition_metadata(cur, 'range')
+                        if metadata is None:
+                            raise Exception("Không tìm thấy metadata của phân mảnh theo khoảng.")
+                        range_indexes = [_range_index(row[2], metadata[2]) for _, row, _ in range_items]
+                    rrobin_indexes = []
+                    if rrobin_items:
+                        # Giữ chỗ liên tiếp cho cả lô theo đúng thứ tự gửi
+                        slot = _reserve_rrobin_slots(cur, len(rrobin_items))
+                        if slot is None:
+                            raise Exception("Không tìm thấy metadata của phân mảnh round-robin.")
+                        first_index, number_of_partitions = slot
+                        rrobin_indexes = [(first_index + k) % number_of_partitions for k in range(len(rrobin_items))]
+                self._control.commit()
+            except Exception as ex:
+                self._control.rollback()
+                for _, _, future in batch:
+                    future.set_exception(ex)
+                continue
+            self._in_flight.acquire()
+            self._writers.submit(self._write, range_items, range_indexes, rrobin_items, rrobin_indexes)
+
+    def _write(self, range_items, range_indexes, rrobin_items, rrobin_indexes):
+        try:
+            attempt = 0
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = None
+                try:
+                    if conn is None:
+                        conn = self._connect()
+                    with conn.cursor() as cur:
+                        if rrobin_items:
+                            _copy_rows(cur, self.ratingstablename, [row for _, row, _ in rrobin_items])
+                            _write_partition_groups(cur, 'rrobin_part', [row for _, row, _ in rrobin_items],
+                                                    rrobin_indexes)
+                        if range_items:
+                            _write_partition_groups(cur, 'range_part', [row for _, row, _ in range_items],
+                                                    range_indexes)
+                    conn.commit()
+                except Exception as ex:
+                    if conn is not None and not conn.closed:
+                        conn.rollback()
+                        self._idle.put(conn)
+                    if not isinstance(ex, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                        # Lỗi không tạm thời (vd. bảng mảnh đã bị xóa) không tự hết khi thử lại
+                        for _, _, future in range_items + rrobin_items:
+                            future.set_exception(ex)
+                        if rrobin_items:
+                            print(f'Ghi {len(rrobin_items)} dòng round-robin thất bại, '
+                                  f'các vị trí đã giữ bị bỏ trống: {str(ex)}')
+                        return
+                    if attempt == self._retries:
+                        for _, _, future in range_items:
+                            future.set_exception(ex)
+                        range_items, range_indexes = [], []
+                        if rrobin_items:
+                            # Các vị trí round-robin đã được giữ: ghi lại tới khi thành công để dãy không bị hở
+                            print(f'Ghi {len(rrobin_items)} dòng round-robin thất bại, đang thử lại: {str(ex)}')
+                    if not rrobin_items and attempt >= self._retries:
+                        return
+                    attempt += 1
+                    if attempt > self._retries:
+                        time.sleep(min(0.1 * 2 ** (attempt - self._retries - 1), 5))
+                    continue
+                self._idle.put(conn)
+                for (_, _, future), i in zip(range_items, range_indexes):
+                    future.set_result(f'range_part{i}')
+                for (_, _, future), i in zip(rrobin_items, rrobin_indexes):
+                    future.set_result(f'rrobin_part{i}')
+                return
+        finally:
+            self._in_flight.release()
+
+class _QueueReader:
+    """
+    File-like source for COPY ... FROM STDIN reading byte chunks from a queue; None ends the data.
+    Reading stops with an error as soon as `stop` is set.
+    """
+    def __init__(self, q, stop):
+        self._queue = q
+        self._stop = stop
+        self._buf = b''
+        self._pos = 0
+        self._done = False
+
+    def read(self, size=-1):
+        while self._pos >= len(self._buf) and not self._done:
+            if self._stop.is_set():
+                raise RuntimeError('Đã dừng nạp dữ liệu do lỗi ở luồng khác')
+            try:
+                chunk = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                self._done = True
+            else:
+                self._buf, self._pos = chunk, 0
+        if size is None or size < 0:
+            size = len(self._buf) - self._pos
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+class _PartitionDemux:
+    """
+    File-like sink for COPY ... TO STDOUT whose last column is the partition index. Every line is
+    forwarded without that column to the queue of its partition, in chunks of about chunk_size bytes.
+    """
+    def __init__(self, queues, stop, chunk_size=COPY_CHUNK_SIZE):
+        self._queues = queues
+        self._stop = stop
+        self._chunk_size = chunk_size
+        self._pending = [[] for _ in queues]
+        self._sizes = [0] * len(queues)
+        self._rest = b''
+        self.rows = [0] * len(queues)
+
+    def write(self, data):
+        if self._stop.is_set():
+            raise RuntimeError('Một node đã dừng nhận dữ liệu')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        lines = (self._rest + data).split(b'\n')
+        self._rest = lines.pop()
+        for line in lines:
+            row, _, part = line.rpartition(b'\t')
+            # Dòng không thuộc mảnh nào (part là NULL) bị bỏ qua giống _fanout_partitions
+            if part == b'\\N':
+                continue
+            i = int(part)
+            self._pending[i].append(row)
+            self._sizes[i] += len(row) + 1
+            self.rows[i] += 1
+            if self._sizes[i] >= self._chunk_size:
+                self._flush(i)
+        return len(data)
+
+    def _flush(self, i):
+        if self._pending[i]:
+            _put_unless_stopped(self._queues[i], b'\n'.join(self._pending[i]) + b'\n', self._stop)
+            self._pending[i] = []
+            self._sizes[i] = 0
+
+    def close(self):
+        for i in range(len(self._queues)):
+            self._flush(i)
+
+def _copy_demux_partitions(cur, source_sql, prefix, connects, replace=False, unlogged=False):
+    """
+    Route every row of source_sql (userid, movieid, rating, part) into prefix0..prefixN-1 in one
+    pass: cur streams the rows out with a single COPY TO, _PartitionDemux splits them by part and
+    partition i is loaded by its own COPY FROM on a connection from connects[i], all in parallel.
+    Nothing is committed unless every partition was loaded; a commit failing midway drops the
+    partitions committed before it. With replace=True existing partition tables are dropped first.
+    Returns (row count, load time) of every partition.
+    """
+    n = len(connects)
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=4) for _ in range(n)]
+    demux = _PartitionDemux(queues, stop)
+    # Lỗi được ghi theo thứ tự xảy ra: lỗi đầu tiên là nguyên nhân, các lỗi sau chỉ do dừng theo
+    errors = []
+
+    def load(i):
+        start_time = time.perf_counter()
+        conn = connects[i]()
+        try:
+            with conn.cursor() as part_cur:
+                if replace:
+                    part_cur.execute(f'DROP TABLE IF EXISTS {prefix}{i}')
+                _create_partition_tables(part_cur, prefix, i + 1, start=i, unlogged=unlogged)
+                part_cur.copy_expert(f'COPY {prefix}{i} (userid, movieid, rating) FROM STDIN',
+                                     _QueueReader(queues[i], stop), size=COPY_CHUNK_SIZE)
+        except Exception as ex:
+            errors.append(ex)
+            stop.set()
+            conn.close()
+            raise
+        return conn, time.perf_counter() - start_time
+
+    results = []
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        futures = [executor.submit(load, i) for i in range(n)]
+        try:
+            cur.copy_expert(f'COPY ({source_sql}) TO STDOUT', demux, size=COPY_CHUNK_SIZE)
+            demux.close()
+        except Exception as ex:
+            errors.append(ex)
+            stop.set()
+        for q in queues:
+            _put_unless_stopped(q, None, stop)
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception:
+                pass
+    if errors:
+        for conn, _ in results:
+            conn.rollback()
+            conn.close()
+        raise errors[0]
+    _trace_statement_rows(cur, sum(demux.rows))
+
+    committed = []
+    try:
+        for i, (conn, _) in enumerate(results):
+            conn.commit()
+            committed.append(i)
+    except Exception:
+        # Commit lỗi giữa chừng: xóa các mảnh đã commit trước đó, các mảnh còn lại bị rollback khi đóng kết nối
+        for i in committed:
+            conn = results[i][0]
+            with conn.cursor() as part_cur:
+                part_cur.execute(f'DROP TABLE IF EXISTS {prefix}{i}')
+            conn.commit()
+        raise
+    finally:
+        for conn, _ in results:
+            conn.close()
+    return [(rows, seconds) for rows, (_, seconds) in zip(demux.rows, results)]
+
+class NodePlacement:
+    """
+    Places partition tables on several PostgreSQL nodes. nodes is a list of DSNs (or zero-argument
+    callables returning connections), e.g. ['port=5432 dbname=dds', 'port=5433 dbname=dds'].
+    nodes[0] is the coordinator: it holds the ratings table and partition_metadata.
+    partition() places partition i on assignment(n)[i]: round-robin over the nodes, or in
+    proportion to `weights` when given. The placement is saved in partition_metadata as node ids
+    (cluster system identifier and database name), and inserts and counts route from the saved
+    placement, so a placement reopened with the same coordinator as nodes[0] but the other nodes in
+    another order or with other weights still finds every partition. The metadata lives on the
+    coordinator, so reopening with another nodes[0] does not find it; a partition on a node that
+    is not in `nodes` is an error.
+    """
+    def __init__(self, nodes, weights=None):
+        if not nodes:
+            raise ValueError('Cần ít nhất một node')
+        if weights is not None and (len(weights) != len(nodes) or min(weights) <= 0):
+            raise ValueError(f'Trọng số không hợp lệ: {weights}')
+        self.nodes = list(nodes)
+        self.weights = list(weights) if weights is not None else None
+        # functools.partial của psycopg2.connect pickle được, nên dùng được cho loadratings(workers > 1)
+        self._factories = [functools.partial(psycopg2.connect, node) if isinstance(node, str) else node
+                           for node in self.nodes]
+        self._connections = {}
+        self._layouts = {}
+        self._node_ids = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
+
+    def connect(self, node):
+        """
+        Open a new connection to a node.
+        """
+        return self._factories[node]()
+
+    def _connection(self, node):
+        # Kết nối dùng lại cho các lệnh chèn từng dòng
+        conn = self._connections.get(node)
+        if conn is None or conn.closed:
+            conn = self._connections[node] = self.connect(node)
+        return conn
+
+    def assignment(self, numberofpartitions):
+        """
+        Node index of every partition.
+        """
+        _check_partition_count(numberofpartitions)
+        if self.weights is None:
+            return [i % len(self.nodes) for i in range(numberofpartitions)]
+        # Smooth weighted round-robin: node có trọng số gấp đôi nhận gấp đôi số mảnh,
+        # và các mảnh của cùng một node được rải đều thay vì dồn liền nhau
+        current = [0] * len(self.nodes)
+        total = sum(self.weights)
+        result = []
+        for _ in range(numberofpartitions):
+            for j, weight in enumerate(self.weights):
+                current[j] += weight
+            best = max(range(len(self.nodes)), key=current.__getitem__)
+            current[best] -= total
+            result.append(best)
+        return result
+
+    def node_ids(self):
+        """
+        Id ('system identifier/database') of every configured node, as saved in partition_metadata.
+        """
+        if self._node_ids is None:
+            ids = []
+            for node in range(len(self.nodes)):
+                with self._connection(node).cursor() as cur:
+                    # Mã định danh của cụm PostgreSQL khác nhau giữa các máy, kể cả khi cùng cổng 5432
+                    # và cùng tên cơ sở dữ liệu, và không đổi theo địa chỉ dùng để kết nối
+                    cur.execute("SELECT system_identifier || '/' || current_database() FROM pg_control_system()")
+                    ids.append(cur.fetchone()[0])
+                self._connection(node).commit()
+            if len(set(ids)) != len(ids):
+                raise ValueError(f'Các node bị trùng: {ids}')
+            self._node_ids = ids
+        return self._node_ids
+
+    def _layout(self, scheme):
+        """
+        (numberofpartitions, range bounds, node index of every partition) saved by partition().
+        """
+        if scheme not in self._layouts:
+            coordinator = self._connection(0)
+            with coordinator.cursor() as cur:
+                metadata = _load_partition_metadata(cur, scheme)
+                saved_nodes = _load_partition_nodes(cur, scheme) if metadata is not None else None
+            coordinator.commit()
+            if metadata is None or saved_nodes is None:
+                raise Exception(f"Không tìm thấy metadata của lược đồ phân mảnh {scheme} trên nhiều node.")
+            ids = self.node_ids()
+            missing = sorted(set(saved_nodes) - set(ids))
+            if missing:
+                raise Exception(f"Các mảnh {scheme} nằm trên node không được cấu hình: {missing}")
+            self._layouts[scheme] = (metadata[0], metadata[2], [ids.index(node_id) for node_id in saved_nodes])
+        return self._layouts[scheme]
+
+    def _rollback(self):
+        for conn in self._connections.values():
+            if not conn.closed:
+                conn.rollback()
+
+    def loadratings(self, ratingstablename, ratingsfilepath, workers=1, binary=False):
+        """
+        Load the ratings file into the coordinator.
+        """
+        loadratings(ratingstablename, ratingsfilepath, self._connection(0), workers, self._factories[0], binary)
+
+    def partition(self, ratingstablename, numberofpartitions, scheme='range', equidepth=False, sample_percent=None):
+        """
+        Build range or round-robin partitions on their nodes. The coordinator scans ratings once
+        with COPY TO; the rows are demultiplexed to one COPY FROM per partition, all running in
+        parallel (see _copy_demux_partitions). Nothing is committed unless every partition was
+        loaded; a commit failing midway drops the partitions committed before it.
+        equidepth and sample_percent choose range bounds as in rangepartition.
+        """
+        try:
+            prefix = SCHEME_PREFIXES[scheme]
+            if scheme == 'range':
+                bounds = _range_bounds(numberofpartitions)
+                if equidepth:
+                    with self._connection(0).cursor() as cur:
+                        bounds = _equidepth_bounds(_range_histogram(cur, ratingstablename, sample_percent),
+                                                   numberofpartitions)
+                part_sql = _range_bucket_sql(bounds)
+            elif scheme == 'rrobin':
+                bounds = None
+                _check_partition_count(numberofpartitions)
+                part_sql = f'MOD(ROW_NUMBER() OVER () - 1, {numberofpartitions})'
+            else:
+                raise ValueError(f'Lược đồ phân mảnh không hỗ trợ nhiều node: {scheme}')
+            nodes = self.assignment(numberofpartitions)
+            self.node_ids()
+            coordinator = self._connection(0)
+            start_time = time.perf_counter()
+            with coordinator.cursor() as cur:
+                loaded = _copy_demux_partitions(
+                    cur, f'SELECT userid, movieid, rating, {part_sql} FROM {ratingstablename}', prefix,
+                    [functools.partial(self.connect, node) for node in nodes], replace=True)
+            total_rows = sum(count for count, _ in loaded)
+            # Lưu vị trí của từng mảnh: các lệnh chèn và đếm về sau định tuyến theo đó
+            node_ids = self.node_ids()
+            with coordinator.cursor() as cur:
+                _save_partition_metadata(cur, scheme, numberofpartitions,
+                                         next_index=total_rows if scheme == 'rrobin' else None, bounds=bounds,
+                                         nodes=[node_ids[node] for node in nodes])
+            coordinator.commit()
+            self._layouts.pop(scheme, None)
+
+            elapsed = time.perf_counter() - start_time
+            for i, (rows, seconds) in enumerate(loaded):
+                print(f"  {prefix}{i} -> node {nodes[i]}: {rows} rows, {seconds:.3f}s")
+            print(f"Phân mảnh {scheme} trên {len(set(nodes))} node hoàn thành: {total_rows} rows, {elapsed:.3f}s")
+        except Exception as ex:
+            self._rollback()
+            print(f'Phân mảnh trên nhiều node thất bại: {str(ex)}')
+
+    def rangeinsert(self, ratingstablename, userid, movieid, rating):
+        """
+        Insert a new record into the range partition of its rating, on the owning node.
+        """
+        try:
+            _, bounds, nodes = self._layout('range')
+            i = _range_index(rating, bounds)
+            conn = self._connection(nodes[i])
+            with conn.cursor() as cur:
+                cur.execute(f"INSERT INTO range_part{i} (userid, movieid, rating) VALUES (%s, %s, %s)",
+                            (userid, movieid, rating))
+            conn.commit()
+        except Exception as ex:
+            self._rollback()
+            print(f'Chèn dữ liệu vào phân mảng ngang theo khoảng thất bại: {str(ex)}')
+
+    def roundrobininsert(self, ratingstablename, userid, movieid, rating):
+        """
+        Insert a new record into ratings on the coordinator and into the next round-robin
+        partition on its node. The two commits are not atomic across nodes.
+        """
+        try:
+            _, _, nodes = self._layout('rrobin')
+            coordinator = self._connection(0)
+            with coordinator.cursor() as cur:
+                cur.execute(f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES (%s, %s, %s)",
+                            (userid, movieid, rating))
+                slot = _reserve_rrobin_slots(cur, 1)
+            if slot is None:
+                raise Exception("Không tìm thấy metadata của phân mảnh round-robin.")
+            next_index, numberofpartitions = slot
+            i = next_index % numberofpartitions
+            conn = self._connection(nodes[i])
+            with conn.cursor() as cur:
+                cur.execute(f"INSERT INTO rrobin_part{i} (userid, movieid, rating) VALUES (%s, %s, %s)",
+                            (userid, movieid, rating))
+            # Commit mảnh trước rồi mới commit coordinator, lúc đó khóa con trỏ round-robin mới được nhả
+            conn.commit()
+            coordinator.commit()
+        except Exception as ex:
+            self._rollback()
+            print(f'Chèn dữ liệu vào phân mảng ngang theo round-robin thất bại: {str(ex)}')
+
+    def countpartitions(self, scheme):
+        """
+        Row count of every partition of a scheme, counted on all nodes in parallel.
+        """
+        numberofpartitions, _, nodes = self._layout(scheme)
+
+        def count(i):
+            conn = self.connect(nodes[i])
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(f'SELECT COUNT(*) FROM {SCHEME_PREFIXES[scheme]}{i}')
+                    return cur.fetchone()[0]
+            finally:
+                conn.close()
+
+        with ThreadPoolExecutor(max_workers=numberofpartitions) as executor:
+            return list(executor.map(count, range(numberofpartitions)))
+
+    def verify(self, ratingstablename, scheme):
+        """
+        Check that the partitions of a scheme together hold exactly the rows of ratings.
+        """
+        counts = self.countpartitions(scheme)
+        coordinator = self._connection(0)
+        with coordinator.cursor() as cur:
+            cur.execute(f'SELECT COUNT(*) FROM {ratingstablename}')
+            total = cur.fetchone()[0]
+        coordinator.commit()
+        print(f"{scheme}: {sum(counts)} / {total} rows trong các mảnh {counts}")
+        return sum(counts) == total
+
+def _partition_layout(cur, scheme, prefix):
+    """
+    Return (numberofpartitions, range bounds) of a scheme from metadata, or by counting its tables.
+    """
+    metadata = _load_partition_metadata(cur, scheme)
+    if metadata is not None:
+        return metadata[0], metadata[2]
+    cur.execute("SELECT COUNT(*) FROM pg_stat_user_tables WHERE relname LIKE %s", (f'{prefix}%',))
+    number_of_partitions = cur.fetchone()[0]
+    bounds = _range_bounds(number_of_partitions) if scheme == 'range' and number_of_partitions else None
+    return number_of_partitions, bounds
+
+def _put_unless_stopped(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def _stream_partitions(tables, where, params, connect, workers=None, batch_size=QUERY_BATCH_SIZE):
+    """
+    Query every table concurrently through server-side cursors and yield the merged rows as
+    (table name, userid, movieid, rating). A bounded queue keeps client memory constant.
+    """
+    if not tables:
+        return
+    results = queue.Queue(maxsize=4 * len(tables))
+    stop = threading.Event()
+
+    def scan(tb_name):
+        error = None
+        try:
+            if stop.is_set():
+                return
+            conn = connect()
+            try:
+                with conn.cursor(name=f'scan_{tb_name}') as cur:
+                    cur.itersize = batch_size
+                    cur.execute(f'SELECT userid, movieid, rating FROM {tb_name} WHERE {where}', params)
+                    while not stop.is_set():
+                        rows = cur.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        _put_unless_stopped(results, (tb_name, rows), stop)
+                conn.rollback()
+            finally:
+                conn.close()
+        except Exception as ex:
+            error = ex
+        finally:
+            # Báo cho luồng đọc biết worker đã kết thúc (kèm lỗi nếu có)
+            _put_unless_stopped(results, (None, error), stop)
+
+    with ThreadPoolExecutor(max_workers=workers or len(tables)) as executor:
+        for tb_name in tables:
+            executor.submit(scan, tb_name)
+        remaining = len(tables)
+        try:
+            while remaining:
+                tb_name, rows = results.get()
+                if tb_name is None:
+                    remaining -= 1
+                    if rows is not None:
+                        raise rows
+                    continue
+                for row in rows:
+                    yield (tb_name,) + tuple(row)
+        finally:
+            stop.set()
+
+def _query_tables(openconnection, scheme, ranges):
+    """
+    Partition tables of one scheme that can hold ratings in any of `ranges` ([low, high] pairs).
+    Range partitions are pruned by their bounds; every round-robin or hash partition is kept.
+    """
+    if scheme not in SCHEME_PREFIXES:
+        raise ValueError(f'Lược đồ phân mảnh không hợp lệ: {scheme}')
+    prefix = SCHEME_PREFIXES[scheme]
+    with openconnection.cursor() as cur:
+        count, bounds = _partition_layout(cur, scheme, prefix)
+    if scheme != 'range':
+        return [f'{prefix}{i}' for i in range(count)]
+    return [f'{prefix}{i}' for i in range(count)
+            if any((i == 0 or bounds[i - 1] < high) and bounds[i] >= low for low, high in ranges)]
+
+def rangequery(min_rating, max_rating, openconnection, workers=None, connect=None, scheme='range'):
+    """
+    Yield (partition name, userid, movieid, rating) of every rating in [min_rating, max_rating]
+    from the partitions of one scheme. For range partitioning only the partitions whose bounds
+    overlap the predicate are read; round-robin partitions are all read concurrently.
+    """
+    tables = _query_tables(openconnection, scheme, [(min_rating, max_rating)])
+    yield from _stream_partitions(tables, 'rating >= %s AND rating <= %s', (min_rating, max_rating),
+                                  _connection_factory(openconnection, connect), workers)
+
+def pointquery(rating, openconnection, workers=None, connect=None, scheme='range'):
+    """
+    Yield (partition name, userid, movieid, rating) of every rating equal to `rating` from the
+    partitions of one scheme. For range partitioning only the partition that can hold the value
+    is read; round-robin partitions are all read concurrently.
+    """
+    tables = _query_tables(openconnection, scheme, [(rating, rating)])
+    yield from _stream_partitions(tables, 'rating = %s', (rating,),
+                                  _connection_factory(openconnection, connect), workers)
+
+def _iter_line_blocks(buf, block_size=PARSE_BLOCK_SIZE):
+    """
+    Yield consecutive byte blocks of buf, each ending on a line boundary.
+    """
+    start = 0
+    size = len(buf)
+    while start < size:
+        end = start + block_size
+        if end >= size:
+            end = size
+        else:
+            end = buf.rfind(b'\n', start, end) + 1 or buf.find(b'\n', end) + 1 or size
+        yield buf[start:end]
+        start = end
+
+def _parse_ratings_block(block):
+    """
+    Parse a block of '::'-delimited lines into (userid, movieid, rating) NumPy arrays.
+    """
+    lines = block.count(b'\n') + (0 if block.endswith(b'\n') else 1)
+    with warnings.catch_warnings():
+        # NumPy chỉ cảnh báo khi gặp dữ liệu không phải số, chuyển thành lỗi để phát hiện dòng hỏng
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(block.replace(b'::', b' '), dtype=np.float64, sep=' ')
+        except (ValueError, DeprecationWarning):
+            values = None
+    if values is not None and values.size == 4 * lines:
+        values = values.reshape(-1, 4)
+        return values[:, 0].astype(np.int32), values[:, 1].astype(np.int32), values[:, 2].copy()
+    # Có dòng sai định dạng: phân tích từng dòng như RatingsCopyReader, bỏ qua dòng không đủ 4 trường
+    rows = [parts[:3] for parts in (line.strip().split(b'::') for line in block.splitlines()) if len(parts) == 4]
+    return (np.array([int(r[0]) for r in rows], dtype=np.int32),
+            np.array([int(r[1]) for r in rows], dtype=np.int32),
+            np.array([float(r[2]) for r in rows], dtype=np.float64))
+
+_BINARY_RATING_DTYPE = None if np is None else np.dtype([
+    ('fields', '>i2'), ('userid_len', '>i4'), ('userid', '>i4'), ('movieid_len', '>i4'),
+    ('movieid', '>i4'), ('rating_len', '>i4'), ('rating', '>f8'),
+])
+
+def _binary_copy_payload(userids, movieids, ratings):
+    """
+    Encode column arrays as a complete binary COPY stream in one vectorized step.
+    """
+    rows = np.empty(len(userids), dtype=_BINARY_RATING_DTYPE)
+    rows['fields'] = 3
+    rows['userid_len'] = 4
+    rows['movieid_len'] = 4
+    rows['rating_len'] = 8
+    rows['userid'] = userids
+    rows['movieid'] = movieids
+    rows['rating'] = ratings
+    return _BINARY_COPY_HEADER + rows.tobytes() + _BINARY_COPY_TRAILER
+
+def _copy_binary_columns(cur, tablename, userids, movieids, ratings):
+    cur.copy_expert(f'COPY {tablename} (userid, movieid, rating) FROM STDIN WITH (FORMAT binary)',
+                    io.BytesIO(_binary_copy_payload(userids, movieids, ratings)))
+
+def _copy_partitioned_columns(cur, prefix, numberofpartitions, parts, userids, movieids, ratings):
+    """
+    COPY every row into table prefix + parts[row]; rows with parts >= numberofpartitions are skipped.
+    Returns the number of rows written to each partition.
+    """
+    # Sắp xếp ổn định theo số thứ tự mảnh để giữ nguyên thứ tự dòng trong từng mảnh
+    order = np.argsort(parts, kind='stable')
+    counts = np.bincount(parts, minlength=numberofpartitions)[:numberofpartitions]
+    start = 0
+    for i, count in enumerate(counts):
+        if count:
+            idx = order[start:start + count]
+            _copy_binary_columns(cur, f'{prefix}{i}', userids[idx], movieids[idx], ratings[idx])
+        start += count
+    return counts
+
+class RatingsCache:
+    """
+    On-disk cache of parsed ratings files. Each entry stores the userid (int32), movieid (int32)
+    and rating (float64) columns back to back after a small header, so it can be memory-mapped.
+    Entries are keyed by the source file's path, size and mtime (in nanoseconds) only; the file is
+    not checksummed, so a rewrite that keeps both its size and its mtime is not detected.
+    Once the total size exceeds max_bytes the least recently used entries are evicted.
+    """
+    MAGIC = b'BTLRCOL1'
+    HEADER = struct.Struct('<8sq')
+
+    def __init__(self, directory=RATINGS_CACHE_DIR, max_bytes=RATINGS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, ratingsfilepath):
+        stat = os.stat(ratingsfilepath)
+        # Tiền tố theo đường dẫn file nguồn để xóa các bản cũ khi file thay đổi
+        source = hashlib.blake2b(os.path.abspath(ratingsfilepath).encode(), digest_size=8).hexdigest()
+        key = hashlib.blake2b(f'{stat.st_size}:{stat.st_mtime_ns}'.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, f'{source}-{key}.cols')
+
+    def get(self, ratingsfilepath):
+        """
+        Return memory-mapped (userids, movieids, ratings) of a cached file, or None on a miss.
+        """
+        path = self._entry_path(ratingsfilepath)
+        try:
+            with open(path, 'rb') as f:
+                magic, rows = self.HEADER.unpack(f.read(self.HEADER.size))
+        except (OSError, struct.error):
+            return None
+        if magic != self.MAGIC:
+            return None
+        os.utime(path)
+        if rows == 0:
+            # np.memmap không ánh xạ được vùng rỗng
+            return np.empty(0, dtype='<i4'), np.empty(0, dtype='<i4'), np.empty(0, dtype='<f8')
+        offset = self.HEADER.size
+        userids = np.memmap(path, dtype='<i4', mode='r', offset=offset, shape=(rows,))
+        movieids = np.memmap(path, dtype='<i4', mode='r', offset=offset + 4 * rows, shape=(rows,))
+        ratings = np.memmap(path, dtype='<f8', mode='r', offset=offset + 8 * rows, shape=(rows,))
+        return userids, movieids, ratings
+
+    def writer(self, ratingsfilepath):
+        """
+        Return a _RatingsCacheWriter building the entry of a file block by block.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        return _RatingsCacheWriter(self, self._entry_path(ratingsfilepath))
+
+    def put(self, ratingsfilepath, userids, movieids, ratings):
+        writer = self.writer(ratingsfilepath)
+        try:
+            writer.append(userids, movieids, ratings)
+            writer.commit()
+        finally:
+            writer.close()
+
+    def _stored(self, path):
+        # Bản cache cũ của cùng file nguồn không còn dùng được nữa
+        source = os.path.basename(path).split('-', 1)[0]
+        for name in os.listdir(self.directory):
+            if name.endswith('.cols') and name.startswith(source + '-') and name != os.path.basename(path):
+                os.remove(os.path.join(self.directory, name))
+        self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.cols'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
+
+class _RatingsCacheWriter:
+    """
+    Writes one RatingsCache entry as blocks arrive, so only the current block is held in memory.
+    userids go straight into the entry file after its header; movieids and ratings go into side
+    files that are appended at commit(). close() discards an entry that was not committed.
+    """
+    def __init__(self, cache, path):
+        self._cache = cache
+        self._path = path
+        self._tmp_paths = [path + '.tmp', path + '.tmp1', path + '.tmp2']
+        self._files = [open(tmp_path, 'w+b') for tmp_path in self._tmp_paths]
+        self._files[0].write(cache.HEADER.pack(cache.MAGIC, 0))
+        self.rows = 0
+
+    def append(self, userids, movieids, ratings):
+        for f, column, dtype in zip(self._files, (userids, movieids, ratings), ('<i4', '<i4', '<f8')):
+            f.write(np.asarray(column, dtype=dtype).tobytes())
+        self.rows += len(userids)
+
+    def commit(self):
+        entry = self._files[0]
+        for side in self._files[1:]:
+            side.seek(0)
+            shutil.copyfileobj(side, entry, COPY_CHUNK_SIZE)
+        # Số dòng chỉ biết được ở cuối nên ghi lại header
+        entry.seek(0)
+        entry.write(self._cache.HEADER.pack(self._cache.MAGIC, self.rows))
+        entry.close()
+        os.replace(self._tmp_paths[0], self._path)
+        self._cache._stored(self._path)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        # Sau commit() file .tmp đã được đổi tên thành bản cache nên chỉ còn các file phụ
+        for tmp_path in self._tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def _ratings_column_blocks(ratingsfilepath, cache=None, block_rows=1 << 20):
+    """
+    Yield the ratings file as (userids, movieids, ratings) NumPy blocks, served from `cache`
+    when it holds the file and parsed (then cached, block by block) otherwise.
+    """
+    columns = cache.get(ratingsfilepath) if cache is not None else None
+    if columns is not None:
+        userids, movieids, ratings = columns
+        for start in range(0, len(userids), block_rows):
+            end = start + block_rows
+            yield userids[start:end], movieids[start:end], ratings[start:end]
+        return
+
+    writer = cache.writer(ratingsfilepath) if cache is not None else None
+    try:
+        with open(ratingsfilepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for block in _iter_line_blocks(buf):
+                parsed = _parse_ratings_block(block)
+                if writer is not None:
+                    writer.append(*parsed)
+                yield parsed
+        if writer is not None:
+            writer.commit()
+    finally:
+        # Chưa đọc hết file (lỗi hoặc người dùng dừng sớm): bỏ bản cache dở dang
+        if writer is not None:
+            writer.close()
+
+def loadandpartition(ratingstablename, ratingsfilepath, numberofpartitions, openconnection, scheme='range', cache=None,
+                     equidepth=False):
+    """
+    Load the ratings file and build its range or round-robin partitions in the same pass.
+    The file is memory-mapped and parsed with NumPy in large blocks; each block is copied into
+    ratings and routed to range_partI / rrobin_partI exactly as loadratings followed by
+    rangepartition or roundrobinpartition would place it. A RatingsCache skips the parsing.
+    With equidepth=True the range bounds come from a histogram of the file, built in an extra
+    pass over the rating column (see rangepartition).
+    """
+    try:
+        if np is None:
+            raise ImportError('loadandpartition cần thư viện numpy')
+        if scheme not in ('range', 'rrobin'):
+            raise ValueError(f'Lược đồ phân mảnh không hợp lệ: {scheme}')
+        cur = openconnection.cursor()
+        prefix = 'range_part' if scheme == 'range' else 'rrobin_part'
+        _check_partition_count(numberofpartitions)
+        bounds = np.array(_range_bounds(numberofpartitions)) if scheme == 'range' else None
+        if scheme == 'range' and equidepth:
+            # Lượt đọc thêm chỉ đếm các giá trị rating để lập histogram
+            histogram = {}
+            for _, _, ratings in _ratings_column_blocks(ratingsfilepath, cache):
+                values, counts = np.unique(ratings, return_counts=True)
+                for value, count in zip(values.tolist(), counts.tolist()):
+                    histogram[value] = histogram.get(value, 0) + count
+            bounds = np.array(_equidepth_bounds(sorted(histogram.items()), numberofpartitions))
+
+        cur.execute(f'DROP TABLE IF EXISTS {ratingstablename}')
+        cur.execute(f'CREATE TABLE {ratingstablename} (UserID INTEGER, MovieID INTEGER, Rating FLOAT)')
+        _create_partition_tables(cur, prefix, numberofpartitions)
+
+        start_time = time.perf_counter()
+        total_rows = 0
+        for userids, movieids, ratings in _ratings_column_blocks(ratingsfilepath, cache):
+            _copy_binary_columns(cur, ratingstablename, userids, movieids, ratings)
+
+            # Tính số thứ tự mảnh cho cả khối cùng lúc
+            if scheme == 'range':
+                parts = np.searchsorted(bounds, ratings, side='left')
+            else:
+                parts = (total_rows + np.arange(len(ratings))) % numberofpartitions
+            _copy_partitioned_columns(cur, prefix, numberofpartitions, parts, userids, movieids, ratings)
+            total_rows += len(ratings)
+
+        if scheme == 'range':
+            _save_partition_metadata(cur, 'range', numberofpartitions, bounds=bounds.tolist())
+        else:
+            _save_partition_metadata(cur, 'rrobin', numberofpartitions, total_rows)
+        cur.close()
+        openconnection.commit()
+        elapsed = time.perf_counter() - start_time
+        print(f"Nạp và phân mảnh {total_rows} dòng vào {ratingstablename} và {numberofpartitions} mảnh "
+              f"trong {elapsed:.3f}s ({total_rows / max(elapsed, 1e-9):.0f} rows/s)")
+    except Exception as ex:
+        openconnection.rollback()
+        print(f'Nạp và phân mảnh dữ liệu thất bại: {str(ex)}')
+
+def parallelaggregate(group_by, openconnection, scheme='hash', workers=None, connect=None):
+    """
+    Compute {group value: (count, sum of ratings)} grouped by userid or movieid. Every partition
+    of `scheme` computes its partial aggregate concurrently on its own connection and the
+    partials are merged on the client.
+    """
+    if group_by not in ('userid', 'movieid'):
+        raise ValueError(f'Cột gom nhóm không hợp lệ: {group_by}')
+    prefix = SCHEME_PREFIXES[scheme]
+    with openconnection.cursor() as cur:
+        number_of_partitions, _ = _partition_layout(cur, scheme, prefix)
+    connect = _connection_factory(openconnection, connect)
+
+    def partial(tb_name):
+        conn = connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f'SELECT {group_by}, COUNT(*), SUM(rating) FROM {tb_name} GROUP BY {group_by}')
+                return cur.fetchall()
+        finally:
+            conn.close()
+
+    merged = {}
+    tables = [f'{prefix}{i}' for i in range(number_of_partitions)]
+    with ThreadPoolExecutor(max_workers=workers or max(1, len(tables))) as executor:
+        for rows in executor.map(partial, tables):
+            # Với phân mảnh băm theo chính cột gom nhóm các nhóm không trùng nhau giữa các mảnh,
+            # với các lược đồ khác thì cộng dồn kết quả từng phần
+            for value, count, total in rows:
+                previous = merged.get(value)
+                merged[value] = (count, total) if previous is None else (previous[0] + count, previous[1] + total)
+    return merged
+
+def averageratingpermovie(openconnection, scheme='hash', workers=None, connect=None):
+    """
+    Return {movieid: average rating}, aggregated over the partitions in parallel.
+    """
+    return {movieid: total / count
+            for movieid, (count, total) in parallelaggregate('movieid', openconnection, scheme, workers, connect).items()}
+
+def ratingsperuser(openconnection, scheme='hash', workers=None, connect=None):
+    """
+    Return {userid: number of ratings}, aggregated over the partitions in parallel.
+    """
+    return {userid: count
+            for userid, (count, _) in parallelaggregate('userid', openconnection, scheme, workers, connect).items()}
+
+class _HashingFile:
+    """
+    Wraps a binary file and keeps the SHA-256 and size of everything written to or read from it.
+    """
+    def __init__(self, f):
+        self._file = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+def _snapshot_tables(cur, ratingstablename):
+    """
+    Names of the tables making up the loaded and partitioned state: ratings, every partition
+    table and partition_metadata.
+    """
+    cur.execute(
+        "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public' AND "
+        "(table_name = %s OR table_name = %s OR " + ' OR '.join(['table_name LIKE %s'] * len(SCHEME_PREFIXES)) + ")",
+        [ratingstablename.lower(), METADATA_TABLE] + [f'{prefix}%' for prefix in SCHEME_PREFIXES.values()])
+    return sorted(tb_name for (tb_name,) in cur.fetchall())
+
+def _table_definition(cur, tb_name):
+    """
+    Column definitions and index DDL of a table, enough to recreate it empty.
+    """
+    cur.execute("""
+        SELECT attname, format_type(atttypid, atttypmod), attnotnull FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum
+    """, (tb_name,))
+    columns = [[name, type_name + (' NOT NULL' if notnull else '')] for name, type_name, notnull in cur.fetchall()]
+    cur.execute("SELECT indexdef FROM pg_indexes WHERE schemaname = 'public' AND tablename = %s ORDER BY indexname",
+                (tb_name,))
+    return columns, [indexdef for (indexdef,) in cur.fetchall()]
+
+def snapshot(directory, openconnection, ratingstablename='ratings', workers=4, connect=None):
+    """
+    Dump ratings, every partition table and partition_metadata into `directory` with parallel
+    binary COPY TO, one file per table, plus a manifest with the table definitions, row counts
+    and SHA-256 checksums. All workers read the same exported snapshot, so the dump is consistent.
+    """
+    try:
+        connect = _connection_factory(openconnection, connect)
+        os.makedirs(directory, exist_ok=True)
+        start_time = time.perf_counter()
+
+        # Xuất snapshot của một giao dịch REPEATABLE READ để mọi worker thấy cùng một trạng thái dữ liệu
+        leader = connect()
+        try:
+            leader.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            with leader.cursor() as cur:
+                cur.execute('SELECT pg_export_snapshot()')
+                snapshot_id = cur.fetchone()[0]
+                tables = _snapshot_tables(cur, ratingstablename)
+                definitions = {tb_name: _table_definition(cur, tb_name) for tb_name in tables}
+            if not tables:
+                raise Exception(f'Không tìm thấy bảng {ratingstablename} hay bảng phân mảnh nào.')
+
+            def dump(tb_name):
+                conn = connect()
+                try:
+                    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+                    with conn.cursor() as cur, open(os.path.join(directory, f'{tb_name}.bin'), 'wb') as f:
+                        cur.execute('SET TRANSACTION SNAPSHOT %s', (snapshot_id,))
+                        out = _HashingFile(f)
+                        cur.copy_expert(f'COPY {tb_name} TO STDOUT WITH (FORMAT binary)', out, size=COPY_CHUNK_SIZE)
+                        rows = cur.rowcount if cur.rowcount >= 0 else None
+                    conn.rollback()
+                finally:
+                    conn.close()
+                return {'name': tb_name, 'file': f'{tb_name}.bin', 'columns': definitions[tb_name][0],
+                        'indexes': definitions[tb_name][1], 'rows': rows, 'bytes': out.size,
+                        'sha256': out.sha256.hexdigest()}
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                entries = list(executor.map(dump, tables))
+        finally:
+            leader.close()
+
+        # Ghi manifest sau cùng: thư mục chưa có manifest là snapshot chưa hoàn chỉnh
+        manifest = {'version': SNAPSHOT_VERSION, 'ratingstablename': ratingstablename,
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'tables': entries}
+        manifest_path = os.path.join(directory, SNAPSHOT_MANIFEST)
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        print(f"Snapshot {len(entries)} bảng vào {directory}: {sum(e['bytes'] for e in entries)} bytes, "
+              f"{time.perf_counter() - start_time:.3f}s")
+        return manifest
+    except Exception as ex:
+        print(f'Tạo snapshot thất bại: {str(ex)}')
+
+def restore(directory, openconnection, workers=4, connect=None):
+    """
+    Recreate every table of a snapshot with parallel binary COPY FROM on `workers` connections,
+    verifying the checksums. Each table is recreated, loaded with COPY FREEZE and indexed inside
+    its worker's transaction; nothing is committed unless every table was restored, and partition
+    tables that are not in the snapshot are dropped.
+    """
+    try:
+        connect = _connection_factory(openconnection, connect)
+        with open(os.path.join(directory, SNAPSHOT_MANIFEST), encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"Phiên bản snapshot không hỗ trợ: {manifest.get('version')}")
+        start_time = time.perf_counter()
+
+        def load(cur, tb_name, entry):
+            with open(os.path.join(directory, entry['file']), 'rb') as f:
+                cur.execute(f'DROP TABLE IF EXISTS {tb_name}')
+                cur.execute(f"CREATE TABLE {tb_name} ({', '.join(f'{name} {type_name}' for name, type_name in entry['columns'])})")
+                # Bảng vừa tạo trong cùng giao dịch nên COPY FREEZE được, không cần VACUUM về sau
+                source = _HashingFile(f)
+                cur.copy_expert(f'COPY {tb_name} FROM STDIN WITH (FORMAT binary, FREEZE)', source,
+                                size=COPY_CHUNK_SIZE)
+                if source.sha256.hexdigest() != entry['sha256']:
+                    raise ValueError(f"Checksum của {entry['file']} không khớp")
+                for indexdef in entry['indexes']:
+                    cur.execute(indexdef)
+
+        def drop_stale_tables():
+            # Xóa các mảnh cũ không có trong snapshot để số bảng mỗi lược đồ khớp với snapshot
+            restored = {entry['name'] for entry in manifest['tables']}
+            with openconnection.cursor() as cur:
+                for tb_name in _snapshot_tables(cur, manifest['ratingstablename']):
+                    if tb_name not in restored:
+                        cur.execute(f'DROP TABLE IF EXISTS {tb_name}')
+
+        _run_in_worker_transactions([(entry['name'], entry) for entry in manifest['tables']], load,
+                                    connect, workers, before_commit=drop_stale_tables)
+        openconnection.commit()
+        print(f"Khôi phục {len(manifest['tables'])} bảng từ {directory}: "
+              f"{sum(entry['rows'] or 0 for entry in manifest['tables'])} rows, {time.perf_counter() - start_time:.3f}s")
+    except Exception as ex:
+        openconnection.rollback()
+        print(f'Khôi phục snapshot thất bại: {str(ex)}')
+
 def drop_and_init_db(dbname, connection):
     """
     Check if the database exists, drop it if it does, and create a new one.
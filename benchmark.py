@@ -0,0 +1,329 @@
+#
+# Benchmark cho BTL_N12: sinh dữ liệu MovieLens giả lập và đo thời gian các hàm chính
+#
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import psycopg2
+
+import testHelper
+import BTL_N12 as MyAssignment
+
+SCALE_FACTORS = {
+    '100k': 100_000,
+    '1m': 1_000_000,
+    '10m': 10_000_000,
+    '100m': 100_000_000,
+}
+
+# Phân bố rating xấp xỉ bộ MovieLens 10M (tập trung quanh 3 - 4 sao)
+RATING_WEIGHTS = {
+    0.5: 0.012, 1.0: 0.038, 1.5: 0.012, 2.0: 0.079, 2.5: 0.037,
+    3.0: 0.236, 3.5: 0.088, 4.0: 0.288, 4.5: 0.059, 5.0: 0.151,
+}
+
+def generate_ratings(filepath, rows, seed=0, users=None, movies=None):
+    """
+    Write `rows` MovieLens-format lines (UserID::MovieID::Rating::Timestamp) to filepath.
+    User activity and movie popularity are skewed like the real dataset.
+    """
+    rng = random.Random(seed)
+    users = users or max(1, rows // 140)
+    movies = movies or max(1, min(65_000, rows // 150))
+    ratings = list(RATING_WEIGHTS)
+    weights = list(RATING_WEIGHTS.values())
+    chunk = 100_000
+    with open(filepath, 'w', encoding='utf-8') as f:
+        written = 0
+        while written < rows:
+            n = min(chunk, rows - written)
+            # Lũy thừa của random() cho phân bố lệch: phim phổ biến và người dùng tích cực
+            # chiếm phần lớn lượt đánh giá
+            lines = [
+                f"{int(users * rng.random() ** 2) + 1}::"
+                f"{int(movies * rng.random() ** 3) + 1}::"
+                f"{r:g}::{rng.randint(789_652_009, 1_231_131_736)}\n"
+                for r in rng.choices(ratings, weights, k=n)
+            ]
+            f.writelines(lines)
+            written += n
+    return filepath
+
+# Các hàm của BTL_N12 tự bắt lỗi và chỉ in thông báo, nên lần chạy có các chuỗi này trong output là lần chạy lỗi
+FAILURE_MARKERS = ('thất bại', 'Error')
+
+class BenchmarkError(Exception):
+    pass
+
+def peak_rss_kb():
+    # ru_maxrss tính bằng KB trên Linux và là đỉnh của cả tiến trình từ lúc khởi động
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def count_rows(openconnection, pattern):
+    """
+    Total row count of the public tables whose name matches the LIKE pattern.
+    """
+    with openconnection.cursor() as cur:
+        cur.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public' "
+                    "AND table_name LIKE %s", (pattern,))
+        tables = [tb_name for (tb_name,) in cur.fetchall()]
+        total = 0
+        for tb_name in tables:
+            cur.execute(f'SELECT COUNT(*) FROM {tb_name}')
+            total += cur.fetchone()[0]
+    openconnection.commit()
+    return total
+
+def expect_rows(openconnection, expected, *patterns):
+    """
+    Check for measure(): every LIKE pattern must match exactly `expected` rows.
+    """
+    def check():
+        for pattern in patterns:
+            actual = count_rows(openconnection, pattern)
+            if actual != expected:
+                raise BenchmarkError(f'{pattern}: {actual} dòng, cần {expected}')
+    return check
+
+def backend_cpu_seconds(openconnection):
+    """
+    CPU time (user + system) used so far by the server backend of this connection.
+    Only available when PostgreSQL runs on this machine; returns None otherwise.
+    """
+    with openconnection.cursor() as cur:
+        cur.execute('SELECT pg_backend_pid()')
+        pid = cur.fetchone()[0]
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    # utime và stime là trường thứ 14 và 15 của /proc/<pid>/stat
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def drop_partitions(openconnection, scheme=None):
+    """
+    Drop the partitions and metadata of every scheme, or only those of `scheme`.
+    """
+    with openconnection.cursor() as cur:
+        if scheme is None:
+            cur.execute(
+                "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public' "
+                "AND (table_name LIKE 'range_part%%' OR table_name LIKE 'rrobin_part%%' OR table_name = %s)",
+                (MyAssignment.METADATA_TABLE,))
+        else:
+            cur.execute(
+                "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public' "
+                "AND table_name LIKE %s", (MyAssignment.SCHEME_PREFIXES[scheme] + '%',))
+        for (tb_name,) in cur.fetchall():
+            cur.execute(f'DROP TABLE IF EXISTS {tb_name}')
+        if scheme is not None:
+            # Chỉ xóa metadata của lược đồ đang đo, các lược đồ khác vẫn dùng được
+            cur.execute('SELECT to_regclass(%s)', (MyAssignment.METADATA_TABLE,))
+            if cur.fetchone()[0] is not None:
+                cur.execute(f'DELETE FROM {MyAssignment.METADATA_TABLE} WHERE scheme = %s', (scheme,))
+    openconnection.commit()
+
+def measure(name, rows, run, setup=None, warmup=1, repeat=3, openconnection=None, check=None):
+    """
+    Time `run` after `warmup` untimed runs; `setup` is called untimed before every run.
+    When openconnection is given, the server CPU time of its backend is recorded too.
+    Every run fails with BenchmarkError when its output reports an error or when `check`
+    (called untimed after the run) raises, so a broken function never records a timing.
+    peak_rss_kb is the peak of the whole process so far; rss_growth_kb is how much this
+    measurement raised it.
+    Returns a JSON-serialisable result record.
+    """
+    seconds = []
+    server_cpu = []
+    rss_before = peak_rss_kb()
+    for k in range(warmup + repeat):
+        if setup is not None:
+            setup()
+        cpu_before = backend_cpu_seconds(openconnection) if openconnection is not None else None
+        output = io.StringIO()
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            run()
+        elapsed = time.perf_counter() - start_time
+        cpu_after = backend_cpu_seconds(openconnection) if cpu_before is not None else None
+        failures = [line for line in output.getvalue().splitlines()
+                    if any(marker in line for marker in FAILURE_MARKERS)]
+        if failures:
+            raise BenchmarkError(f'{name}: {failures[0]}')
+        if check is not None:
+            check()
+        if k >= warmup:
+            seconds.append(elapsed)
+            if cpu_after is not None:
+                server_cpu.append(cpu_after - cpu_before)
+    best = min(seconds)
+    result = {
+        'name': name,
+        'rows': rows,
+        'runs': seconds,
+        'best': best,
+        'mean': sum(seconds) / len(seconds),
+        'rows_per_sec': rows / best if best else None,
+        'peak_rss_kb': peak_rss_kb(),
+        'rss_growth_kb': peak_rss_kb() - rss_before,
+        'server_cpu_seconds': server_cpu or None,
+    }
+    print(f"{name}: best {best:.3f}s, mean {result['mean']:.3f}s, "
+          f"{result['rows_per_sec'] or 0:.0f} rows/s, peak RSS {result['peak_rss_kb']} KB"
+          + (f", server CPU {min(server_cpu):.3f}s" if server_cpu else ""))
+    return result
+
+def run_benchmarks(ratingsfilepath, rows, openconnection, partitions=5, inserts=1000, warmup=1, repeat=3):
+    table = 'ratings'
+    results = []
+
+    def load():
+        MyAssignment.loadratings(table, ratingsfilepath, openconnection)
+
+    def load_binary():
+        MyAssignment.loadratings(table, ratingsfilepath, openconnection, binary=True)
+
+    # So sánh COPY dạng text và dạng nhị phân: thời gian tổng và CPU phía server
+    loaded = expect_rows(openconnection, rows, table)
+    results.append(measure('loadratings', rows, load, warmup=warmup, repeat=repeat,
+                           openconnection=openconnection, check=loaded))
+    results.append(measure('loadratings_binary', rows, load_binary, warmup=warmup, repeat=repeat,
+                           openconnection=openconnection, check=loaded))
+    load()
+
+    results.append(measure(
+        'rangepartition', rows,
+        lambda: MyAssignment.rangepartition(table, partitions, openconnection),
+        setup=lambda: drop_partitions(openconnection, 'range'), warmup=warmup, repeat=repeat,
+        check=expect_rows(openconnection, rows, 'range_part%')))
+    results.append(measure(
+        'roundrobinpartition', rows,
+        lambda: MyAssignment.roundrobinpartition(table, partitions, openconnection),
+        setup=lambda: drop_partitions(openconnection, 'rrobin'), warmup=warmup, repeat=repeat,
+        check=expect_rows(openconnection, rows, 'rrobin_part%')))
+
+    rng = random.Random(1)
+    batch = [(rng.randint(1, 70_000), rng.randint(1, 65_000), rng.choice(list(RATING_WEIGHTS)))
+             for _ in range(inserts)]
+
+    def range_inserts():
+        for userid, movieid, rating in batch:
+            MyAssignment.rangeinsert(table, userid, movieid, rating, openconnection)
+
+    def rrobin_inserts():
+        for userid, movieid, rating in batch:
+            MyAssignment.roundrobininsert(table, userid, movieid, rating, openconnection)
+
+    results.append(measure('rangeinsert', inserts, range_inserts, warmup=warmup, repeat=repeat))
+    results.append(measure('roundrobininsert', inserts, rrobin_inserts, warmup=warmup, repeat=repeat))
+
+    # Khôi phục từ snapshot so với nạp lại và phân mảnh lại từ file
+    def load_and_partition():
+        load()
+        MyAssignment.rangepartition(table, partitions, openconnection)
+        MyAssignment.roundrobinpartition(table, partitions, openconnection)
+
+    partitioned = expect_rows(openconnection, rows, table, 'range_part%', 'rrobin_part%')
+    results.append(measure('load_and_partition', rows, load_and_partition,
+                           setup=lambda: drop_partitions(openconnection), warmup=warmup, repeat=repeat,
+                           check=partitioned))
+    snapshot_dir = tempfile.mkdtemp(prefix='ratings_snapshot_')
+    try:
+        results.append(measure('snapshot', rows, lambda: MyAssignment.snapshot(snapshot_dir, openconnection),
+                               warmup=warmup, repeat=repeat))
+        results.append(measure('restore', rows, lambda: MyAssignment.restore(snapshot_dir, openconnection),
+                               setup=lambda: drop_partitions(openconnection), warmup=warmup, repeat=repeat,
+                               check=partitioned))
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+    return results
+
+def run_queries(openconnection, lookups):
+    """
+    Typical reads after loading: point and range queries on rating plus (userid, movieid) lookups.
+    """
+    for scheme in ('range', 'rrobin'):
+        for rating in (0.5, 1.5):
+            sum(1 for _ in MyAssignment.pointquery(rating, openconnection, scheme=scheme))
+        sum(1 for _ in MyAssignment.rangequery(4.5, 5, openconnection, scheme=scheme))
+    with openconnection.cursor() as cur:
+        cur.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public' "
+                    "AND table_name LIKE 'rrobin_part%%'")
+        tables = [tb_name for (tb_name,) in cur.fetchall()]
+        union = ' UNION ALL '.join(f'SELECT rating FROM {tb_name} WHERE userid = %s AND movieid = %s'
+                                   for tb_name in tables)
+        for userid, movieid in lookups:
+            cur.execute(union, (userid, movieid) * len(tables))
+            cur.fetchall()
+    openconnection.commit()
+
+def run_bulkload_comparison(ratingsfilepath, rows, openconnection, partitions=5, lookups=200, workers=4,
+                            warmup=1, repeat=3):
+    """
+    Compare load + partition time and the time of later queries with and without bulk-load mode.
+    """
+    table = 'ratings'
+    results = []
+    rng = random.Random(2)
+    pairs = [(rng.randint(1, max(1, rows // 140)), rng.randint(1, 1000)) for _ in range(lookups)]
+
+    def plain():
+        MyAssignment.loadratings(table, ratingsfilepath, openconnection)
+        MyAssignment.rangepartition(table, partitions, openconnection)
+        MyAssignment.roundrobinpartition(table, partitions, openconnection)
+
+    def bulk():
+        MyAssignment.bulkload(table, ratingsfilepath, partitions, openconnection, workers=workers)
+
+    # Lần nạp cuối của mỗi chế độ được giữ lại để đo thời gian truy vấn trên đúng dữ liệu đó
+    for name, load in (('plain', plain), ('bulkload', bulk)):
+        results.append(measure(f'load_{name}', rows, load, setup=lambda: drop_partitions(openconnection),
+                               warmup=warmup, repeat=repeat,
+                               check=expect_rows(openconnection, rows, table, 'range_part%', 'rrobin_part%')))
+        results.append(measure(f'queries_{name}', lookups, lambda: run_queries(openconnection, pairs),
+                               warmup=warmup, repeat=repeat))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark BTL_N12 on synthetic MovieLens data')
+    parser.add_argument('--scale', choices=SCALE_FACTORS, default='100k')
+    parser.add_argument('--partitions', type=int, default=5)
+    parser.add_argument('--inserts', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--bulkload', action='store_true',
+                        help='also compare load and query time with and without bulk-load mode')
+    parser.add_argument('--dbname', default='postgres')
+    parser.add_argument('--data-dir', default='.')
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    rows = SCALE_FACTORS[args.scale]
+    ratingsfilepath = os.path.join(args.data_dir, f'ratings_{args.scale}.dat')
+    if not os.path.exists(ratingsfilepath):
+        print(f'Sinh dữ liệu {rows} dòng vào {ratingsfilepath} ...')
+        generate_ratings(ratingsfilepath, rows)
+
+    with testHelper.getopenconnection(dbname=args.dbname) as conn:
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        testHelper.deleteAllPublicTables(conn)
+        results = run_benchmarks(ratingsfilepath, rows, conn, args.partitions, args.inserts,
+                                 args.warmup, args.repeat)
+        if args.bulkload:
+            results += run_bulkload_comparison(ratingsfilepath, rows, conn, args.partitions,
+                                               warmup=args.warmup, repeat=args.repeat)
+        testHelper.deleteAllPublicTables(conn)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'scale': args.scale, 'rows': rows, 'partitions': args.partitions,
+                   'results': results}, f, indent=2)
+    print(f'Kết quả đã ghi vào {args.output}')
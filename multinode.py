@@ -0,0 +1,45 @@
+#
+# Chạy thử phân mảnh trên nhiều node PostgreSQL (ví dụ nhiều instance cục bộ ở các cổng khác nhau):
+#   python multinode.py --nodes "port=5432 dbname=postgres user=postgres password=admin" \
+#                               "port=5433 dbname=postgres user=postgres password=admin"
+#
+import argparse
+import os
+import sys
+
+import BTL_N12 as MyAssignment
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load, partition and verify ratings across several PostgreSQL nodes')
+    parser.add_argument('--nodes', nargs='+', required=True, help='DSN of every node; the first one is the coordinator')
+    parser.add_argument('--weights', nargs='+', type=float, help='relative share of partitions per node')
+    parser.add_argument('--ratings', default='ratings.dat')
+    parser.add_argument('--ratings-table', default='ratings')
+    parser.add_argument('--partitions', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=100_000,
+                        help='rows to generate when the ratings file does not exist')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.ratings):
+        import benchmark
+        print(f'Sinh dữ liệu {args.rows} dòng vào {args.ratings} ...')
+        benchmark.generate_ratings(args.ratings, args.rows)
+
+    ok = True
+    with MyAssignment.NodePlacement(args.nodes, args.weights) as placement:
+        placement.loadratings(args.ratings_table, args.ratings)
+        for scheme in ('range', 'rrobin'):
+            placement.partition(args.ratings_table, args.partitions, scheme)
+            ok = placement.verify(args.ratings_table, scheme) and ok
+
+        # Chèn thêm một dòng theo mỗi lược đồ, dòng round-robin cũng được thêm vào ratings
+        placement.rangeinsert(args.ratings_table, 100, 2, 3)
+        placement.roundrobininsert(args.ratings_table, 100, 1, 3)
+        # Mỗi lược đồ nhận thêm đúng một dòng nên tổng số dòng của hai lược đồ vẫn bằng nhau
+        ok = placement.verify(args.ratings_table, 'rrobin') and ok
+        range_counts = placement.countpartitions('range')
+        print(f"range sau khi chèn: {range_counts}")
+        ok = ok and sum(range_counts) == sum(placement.countpartitions('rrobin'))
+
+    print('Kiểm tra thành công' if ok else 'Kiểm tra thất bại')
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,25 @@
+#
+# Lưu và khôi phục trạng thái đã nạp và phân mảnh (ratings, các mảnh, partition_metadata)
+#
+import argparse
+
+import psycopg2
+
+import testHelper
+import BTL_N12 as MyAssignment
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Snapshot or restore the ratings and partition tables')
+    parser.add_argument('command', choices=['save', 'restore'])
+    parser.add_argument('directory')
+    parser.add_argument('--dbname', default='postgres')
+    parser.add_argument('--ratings-table', default='ratings')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    with testHelper.getopenconnection(dbname=args.dbname) as conn:
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        if args.command == 'save':
+            MyAssignment.snapshot(args.directory, conn, args.ratings_table, workers=args.workers)
+        else:
+            MyAssignment.restore(args.directory, conn, workers=args.workers)
@@ -1,4 +1,5 @@
 import traceback
+import time
 import psycopg2
 
 RANGE_TABLE_PREFIX = 'range_part'
@@ -65,18 +66,18 @@ def getCountrangepartition(ratingstablename, numberofpartitions, openconnection)
     :return:
     """
     cur = openconnection.cursor()
-    countList = []
     interval = 5.0 / numberofpartitions
-    cur.execute("select count(*) from {0} where rating >= {1} and rating <= {2}".format(ratingstablename,0, interval))
-    countList.append(int(cur.fetchone()[0]))
+    filters = ["count(*) filter (where rating >= {0} and rating <= {1})".format(0, interval)]
 
     lowerbound = interval
     for i in range(1, numberofpartitions):
-        cur.execute("select count(*) from {0} where rating > {1} and rating <= {2}".format(ratingstablename,
-                                                                                          lowerbound,
-                                                                                          lowerbound + interval))
+        filters.append("count(*) filter (where rating > {0} and rating <= {1})".format(lowerbound,
+                                                                                        lowerbound + interval))
         lowerbound += interval
-        countList.append(int(cur.fetchone()[0]))
+
+    # All partitions are counted in one grouped scan of the ratings table
+    cur.execute("select {0} from {1}".format(", ".join(filters), ratingstablename))
+    countList = [int(count) for count in cur.fetchone()]
 
     cur.close()
     return countList
@@ -91,16 +92,35 @@ def getCountroundrobinpartition(ratingstablename, numberofpartitions, openconnec
     :return:
     '''
     cur = openconnection.cursor()
-    countList = []
-    for i in range(0, numberofpartitions):
-        cur.execute(
-            "select count(*) from (select *, row_number() over () from {0}) as temp where (row_number-1)%{1}= {2}".format(
-                ratingstablename, numberofpartitions, i))
-        countList.append(int(cur.fetchone()[0]))
+    # Row i of the table goes to partition i % n, so the counts follow from the total row count
+    cur.execute("select count(*) from {0}".format(ratingstablename))
+    total = int(cur.fetchone()[0])
+    countList = [total // numberofpartitions + (1 if i < total % numberofpartitions else 0)
+                 for i in range(0, numberofpartitions)]
 
     cur.close()
     return countList
 
+
+def getCountpartitions(n, openconnection, prefix, partitionstartindex=0):
+    '''
+    Get number of rows of every partition table with a single query
+    :param n: number of partitions
+    :param openconnection:
+    :param prefix: partition table prefix
+    :param partitionstartindex: index of the first partition table
+    :return: list of row counts, in partition order
+    '''
+    selects = []
+    for i in range(0, n):
+        selects.append('SELECT {0} AS i, COUNT(*) FROM {1}{2}'.format(i, prefix, i + partitionstartindex))
+    with openconnection.cursor() as cur:
+        cur.execute(' UNION ALL '.join(selects))
+        countList = [0] * n
+        for i, count in cur.fetchall():
+            countList[i] = int(count)
+    return countList
+
 # Helpers for Tester functions
 def checkpartitioncount(cursor, expectedpartitions, prefix):
     cursor.execute(
@@ -123,31 +143,38 @@ def totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartin
 
 
 def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+    """
+    Checks the partition count, Completeness, Disjointness and Reconstruction
+    :return: row count of every partition, or None if 'n' is invalid
+    """
     with openconnection.cursor() as cur:
         if not isinstance(n, int) or n < 0:
             # Test 1: Check the number of tables created, if 'n' is invalid
             checkpartitioncount(cur, 0, rangepartitiontableprefix)
+            return None
         else:
             # Test 2: Check the number of tables created, if all args are correct
             checkpartitioncount(cur, n, rangepartitiontableprefix)
 
-            # Test 3: Test Completeness by SQL UNION ALL Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
+            # All partitions are counted once, Tests 3 to 5 reuse the same result
+            countList = getCountpartitions(n, openconnection, rangepartitiontableprefix, partitionstartindex)
+            count = sum(countList)
+
+            # Test 3: Test Completeness
             if count < ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Completeness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
 
-            # Test 4: Test Disjointness by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
+            # Test 4: Test Disjointness
             if count > ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Dijointness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
 
-            # Test 5: Test Reconstruction by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
+            # Test 5: Test Reconstruction
             if count != ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Rescontruction property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
+            return countList
 
 
 def testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
@@ -162,23 +189,23 @@ def testrangerobininsert(expectedtablename, itemid, openconnection, rating, user
         if count != 1:  return False
         return True
 
-def testEachRangePartition(ratingstablename, n, openconnection, rangepartitiontableprefix):
+def testEachRangePartition(ratingstablename, n, openconnection, rangepartitiontableprefix, actualCountList=None):
     countList = getCountrangepartition(ratingstablename, n, openconnection)
-    cur = openconnection.cursor()
+    if actualCountList is None:
+        actualCountList = getCountpartitions(n, openconnection, rangepartitiontableprefix)
     for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(rangepartitiontableprefix, i))
-        count = int(cur.fetchone()[0])
+        count = actualCountList[i]
         if count != countList[i]:
             raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
                 rangepartitiontableprefix, i, count, countList[i]
             ))
 
-def testEachRoundrobinPartition(ratingstablename, n, openconnection, roundrobinpartitiontableprefix):
+def testEachRoundrobinPartition(ratingstablename, n, openconnection, roundrobinpartitiontableprefix, actualCountList=None):
     countList = getCountroundrobinpartition(ratingstablename, n, openconnection)
-    cur = openconnection.cursor()
+    if actualCountList is None:
+        actualCountList = getCountpartitions(n, openconnection, roundrobinpartitiontableprefix)
     for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(roundrobinpartitiontableprefix, i))
-        count = cur.fetchone()[0]
+        count = actualCountList[i]
         if count != countList[i]:
             raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
                 roundrobinpartitiontableprefix, i, count, countList[i]
@@ -222,8 +249,11 @@ def testrangepartition(MyAssignment, ratingstablename, n, openconnection, partit
 
     try:
         MyAssignment.rangepartition(ratingstablename, n, openconnection)
-        testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
-        testEachRangePartition(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX)
+        start = time.perf_counter()
+        countList = testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
+        if countList is not None:
+            testEachRangePartition(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX, countList)
+        print('Range partitioning verified in {0:.3f}s'.format(time.perf_counter() - start))
         return [True, None]
     except Exception as e:
         traceback.print_exc()
@@ -242,8 +272,11 @@ def testroundrobinpartition(MyAssignment, ratingstablename, numberofpartitions,
     """
     try:
         MyAssignment.roundrobinpartition(ratingstablename, numberofpartitions, openconnection)
-        testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
-        testEachRoundrobinPartition(ratingstablename, numberofpartitions, openconnection, RROBIN_TABLE_PREFIX)
+        start = time.perf_counter()
+        countList = testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
+        if countList is not None:
+            testEachRoundrobinPartition(ratingstablename, numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, countList)
+        print('Round robin partitioning verified in {0:.3f}s'.format(time.perf_counter() - start))
     except Exception as e:
         traceback.print_exc()
         return [False, e]